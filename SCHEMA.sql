@@ -13,4 +13,29 @@ CREATE TABLE IF NOT EXISTS redirects (
     location TEXT NOT NULL,
     views BIGINT NOT NULL DEFAULT 0,
     FOREIGN KEY(uid) REFERENCES users(id)
-);
\ No newline at end of file
+);
+
+-- A digest of the normalized location, only set on redirects which can be shared by [OPTIONS] dedupe...
+ALTER TABLE redirects ADD COLUMN IF NOT EXISTS digest BYTEA;
+CREATE INDEX IF NOT EXISTS redirects_digest_idx ON redirects USING hash (digest);
+
+CREATE INDEX IF NOT EXISTS redirects_expiry_idx ON redirects (expiry) WHERE expiry IS NOT NULL;
+
+CREATE SEQUENCE IF NOT EXISTS redirect_ids AS BIGINT;
+
+-- Per redirect view counts bucketed by hour (UTC). Only aggregate counts are stored, never anything about a visitor.
+-- Hours older than [DATABASE] views_hourly_retention are rolled up into redirect_views_daily...
+CREATE TABLE IF NOT EXISTS redirect_views_hourly (
+    id TEXT NOT NULL,
+    hour TIMESTAMPTZ NOT NULL,
+    views BIGINT NOT NULL,
+    PRIMARY KEY (id, hour)
+);
+CREATE INDEX IF NOT EXISTS redirect_views_hourly_hour_idx ON redirect_views_hourly (hour);
+
+CREATE TABLE IF NOT EXISTS redirect_views_daily (
+    id TEXT NOT NULL,
+    day DATE NOT NULL,
+    views BIGINT NOT NULL,
+    PRIMARY KEY (id, day)
+);
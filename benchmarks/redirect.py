@@ -0,0 +1,91 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Microbenchmark for the /{id} redirect route.
+
+Drives the full ASGI application in process, with a stub database, from many distinct client IPs. No network,
+Postgres or Redis is needed, only a config.toml in the working directory. Run from the repository root with:
+
+    python -m benchmarks.redirect [--requests 200000] [--ips 10000]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from typing import TYPE_CHECKING, Any
+
+import server
+
+
+if TYPE_CHECKING:
+    from starlette.types import Message
+
+
+class StubDatabase:
+    async def resolve_redirect(self, identifier: str) -> str | None:
+        return "https://example.com/a/reasonably/long/location"
+
+
+async def receive() -> Message:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message: Message) -> None:
+    pass
+
+
+async def run(app: server.Server, *, requests: int, ips: int) -> float:
+    started: float = time.perf_counter()
+
+    for i in range(requests):
+        scope: dict[str, Any] = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/abcdefgh",
+            "raw_path": b"/abcdefgh",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"host", b"localhost"), (b"user-agent", b"bench")],
+            "client": (f"10.{(i % ips) >> 16 & 255}.{(i % ips) >> 8 & 255}.{i % ips & 255}", 50000),
+            "server": ("localhost", 3131),
+        }
+        await app(scope, receive, send)
+
+    return requests / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the /{id} redirect route.")
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--ips", type=int, default=10_000)
+    args = parser.parse_args()
+
+    app = server.Server(database=StubDatabase())  # type: ignore
+
+    # Starlette builds its middleware stack on the first request...
+    asyncio.run(run(app, requests=1, ips=1))
+
+    rps: float = asyncio.run(run(app, requests=args.requests, ips=args.ips))
+    print(f"{args.requests} requests from {args.ips} IPs: {rps:,.0f} requests/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,12 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from .bloom import *
+from .cache import *
 from .config import config as config
 from .core import *
 from .exceptions import *
 from .logger import *
+from .qr import *
 from .sessions import SessionMiddleware as SessionMiddleware
+from .validation import *
@@ -0,0 +1,73 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+
+
+__all__ = ("BloomFilter",)
+
+
+class BloomFilter:
+    """An in-memory Bloom filter of strings.
+
+    Membership tests never give false negatives; a string which was added is always reported as present. Strings which
+    were never added are reported as present with a probability of roughly ``error_rate``, as long as no more than
+    ``capacity`` strings have been added.
+
+    Parameters
+    ----------
+    capacity: int
+        The amount of strings the filter is sized for.
+    error_rate: float
+        The target false positive rate at ``capacity``. Defaults to 0.01.
+    """
+
+    __slots__ = ("_bits", "size", "hashes", "count")
+
+    def __init__(self, capacity: int, *, error_rate: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+
+        self.size: int = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes: int = max(round(self.size / capacity * math.log(2)), 1)
+        self.count: int = 0
+
+        self._bits: bytearray = bytearray((self.size + 7) // 8)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _indexes(self, value: str, /) -> list[int]:
+        # Double hashing; k indexes derived from two halves of a single digest...
+        digest: int = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=16).digest(), "big")
+        first, second = digest >> 64, (digest & 0xFFFFFFFFFFFFFFFF) | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value: str, /) -> None:
+        bits: bytearray = self._bits
+
+        for index in self._indexes(value):
+            bits[index >> 3] |= 1 << (index & 7)
+
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        bits: bytearray = self._bits
+        return all(bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(value))
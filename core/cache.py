@@ -0,0 +1,165 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from types_ import CacheStats
+
+
+__all__ = ("LRUCache", "SingleFlight")
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded, in-memory LRU cache with optional per-entry expiry.
+
+    Entries are evicted when the cache grows past ``max_size`` (least recently used first), or lazily when they are
+    read after their deadline. Deadlines use `time.monotonic` and are the earlier of the caches ``ttl`` and any
+    ``expires`` passed to `set`.
+
+    Parameters
+    ----------
+    max_size: int
+        The maximum amount of entries to hold.
+    ttl: Optional[float]
+        The default amount of seconds an entry lives for. Defaults to None, which never expires entries.
+    """
+
+    __slots__ = ("_data", "max_size", "ttl", "hits", "misses")
+
+    def __init__(self, max_size: int, *, ttl: float | None = None) -> None:
+        self._data: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self.max_size: int = max(max_size, 0)
+        self.ttl: float | None = ttl
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.peek(key) is not None
+
+    def peek(self, key: K, /) -> V | None:
+        """Return the value for key without affecting recency or the hit/miss counters."""
+        try:
+            value, deadline = self._data[key]
+        except KeyError:
+            return None
+
+        if deadline <= time.monotonic():
+            del self._data[key]
+            return None
+
+        return value
+
+    def get(self, key: K, /) -> V | None:
+        try:
+            value, deadline = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if deadline <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def set(self, key: K, value: V, /, *, expires: float | None = None) -> None:
+        """Store a value.
+
+        Parameters
+        ----------
+        expires: Optional[float]
+            A `time.monotonic` deadline for this entry. The entry expires at the earlier of this and the cache ttl.
+        """
+        if self.max_size == 0:
+            return
+
+        deadline: float = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+        if expires is not None:
+            deadline = min(deadline, expires)
+
+        self._data[key] = (value, deadline)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key: K, /) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> CacheStats:
+        return {"size": len(self._data), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight(Generic[K, V]):
+    """De-duplicates concurrent work for the same key.
+
+    The first caller for a key starts the work as a task and every caller which arrives before it finishes awaits the
+    same result. Callers being cancelled never cancels the shared work.
+    """
+
+    __slots__ = ("_calls", "shared")
+
+    def __init__(self) -> None:
+        self._calls: dict[K, asyncio.Future[V]] = {}
+        self.shared: int = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: K, factory: Callable[[], Awaitable[V]], /) -> V:
+        future: asyncio.Future[V] | None = self._calls.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(future)
+
+    def _done(self, key: K, future: asyncio.Future[V], /) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+        # Mark the exception as retrieved, in case every caller was cancelled...
+        if not future.cancelled():
+            future.exception()
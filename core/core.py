@@ -24,6 +24,8 @@ from __future__ import annotations
 
 import asyncio
 import inspect
+import math
+import sys
 from typing import TYPE_CHECKING, Any, Literal, Self
 
 from starlette.applications import Starlette
@@ -31,7 +33,9 @@ from starlette.requests import Request
 from starlette.responses import JSONResponse
 from starlette.routing import Route
 
-from .limiter import RateLimit, Store
+from .config import config
+from .limiter import MemoryBackend, RateLimit, RedisBackend, get_backend
+from .network import client_ip
 
 
 if TYPE_CHECKING:
@@ -39,7 +43,15 @@ if TYPE_CHECKING:
 
     from starlette.types import Receive, Scope, Send
 
-    from types_ import ExemptCallable, LimitDecorator, RateLimitData, ResponseType, T_LimitDecorator
+    from types_ import (
+        ExemptCallable,
+        LimitDecorator,
+        LimiterBackendName,
+        RateLimitData,
+        ResponseType,
+        T_LimitDecorator,
+        User,
+    )
 
 
 __all__ = (
@@ -54,42 +66,122 @@ __all__ = (
 )
 
 
+DONATOR_MULTIPLIER: int = config.get("LIMITER", {}).get("donator_multiplier", 5)
+
+
+def _header(scope: Scope, name: bytes, /) -> str | None:
+    # Reads a single header straight from the ASGI scope; names must be lowercase...
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+
+    return None
+
+
 class _Route:
     def __init__(self, **kwargs: Any) -> None:
         self._path: str = kwargs["path"]
         self._coro: Callable[[Any, Request], ResponseType] = kwargs["coro"]
         self._methods: list[str] = kwargs["methods"]
         self._prefix: bool = kwargs["prefix"]
-        self._limits: RateLimitData = kwargs.get("limits", {})
+        self._session: bool = kwargs.get("session", False)
+        self._set_limits(kwargs.get("limits", {}))
 
         self._view: View | None = None
 
+    def _set_limits(self, limits: RateLimitData, /) -> None:
+        # Everything the limiter needs is built once here rather than on every request...
+        self._limits: RateLimitData = limits
+        self._suffix: str = sys.intern(f"@{self._path}")
+
+        self._limit: RateLimit | None = None
+        self._donator_limit: RateLimit | None = None
+        self._backend: MemoryBackend | RedisBackend | None = None
+        self._user_bucket: bool = False
+        self._exempt: ExemptCallable = None
+
+        if not limits:
+            return
+
+        self._limit = RateLimit(limits["rate"], limits["per"])
+        self._donator_limit = RateLimit(limits["rate"] * DONATOR_MULTIPLIER, limits["per"])
+        self._user_bucket = limits["bucket"] == "user"
+        self._exempt = limits.get("exempt", None)
+
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         request = Request(scope, receive, send)
-        ip: str = request.headers.get("X-Forwarded-For", None) or request.client.host  # type: ignore
-
-        exempt: ExemptCallable = self._limits.get("exempt", None)
-        if exempt is not None and await exempt(request):
-            pass
 
-        elif self._limits and ip not in ("127.0.0.1", "::1"):
-            limit: RateLimit = RateLimit(self._limits["rate"], self._limits["per"])  # TODO: Buckets...
-            key: str = f"{ip}@{self._path}"
+        if self._limit is not None and not (self._exempt is not None and await self._exempt(request)):
+            ip: str | None = client_ip(scope, _header(scope, b"x-forwarded-for"))
 
-            if retry := Store.update(key, limit):
+            if ip is not None and (retry := await self._check(request, ip)):
                 response = JSONResponse(
                     {"error": "You are requesting too fast. Slow down!"},
                     status_code=429,
-                    headers={"Retry-After": str(retry)},
+                    headers={"Retry-After": str(math.ceil(retry))},
                 )
                 await response(scope, receive, send)
                 return
 
+        if self._session and (session := scope.get("session")) is not None:
+            await session.load()
+
         response = await self._coro(self._view, request)
         await response(scope, receive, send)
 
+    async def _check(self, request: Request, ip: str) -> bool | float:
+        # Returns the amount of seconds to retry after when limited, otherwise False...
+        if self._backend is None:
+            # The backend is resolved on first use, so the Redis backend is never created unless a route needs it...
+            self._backend = get_backend(self._limits.get("backend"))
+
+        limit: RateLimit = self._limit  # type: ignore
+        if not self._user_bucket:
+            return await self._backend.update(ip + self._suffix, limit)
+
+        app: Application = request.app
+        user: User | None
+
+        # API clients authenticate with their token; web users with a logged in session...
+        token: str | None = _header(request.scope, b"authorization")
+        uid: int | None = None
+
+        if token:
+            token = token.removeprefix("Bearer ").strip() or None
+        elif (session := request.scope.get("session")) is not None:
+            uid = (await session.load()).get("uid")
+
+        if token is None and uid is None:
+            return await self._backend.update(ip + self._suffix, limit)
 
-def route(path: str, /, *, methods: list[str] = ["GET"], prefix: bool = True) -> Callable[..., _Route]:
+        cached: User | Literal[False] | None = app.peek_user(token=token, uid=uid)
+
+        if cached is False:
+            return await self._backend.update(ip + self._suffix, limit)
+
+        if cached is None:
+            # Looking up unknown credentials costs a query, so it is paid for from the IP bucket first...
+            if retry := await self._backend.update(ip + self._suffix, limit):
+                return retry
+
+            user = await app.fetch_user(token=token, uid=uid)
+            if user is None:
+                return False
+        else:
+            user = cached
+
+        if user["moderator"]:
+            return False
+
+        if user["donator"]:
+            limit = self._donator_limit  # type: ignore
+
+        return await self._backend.update(f"user:{user['id']}{self._suffix}", limit)
+
+
+def route(
+    path: str, /, *, methods: list[str] = ["GET"], prefix: bool = True, session: bool = False
+) -> Callable[..., _Route]:
     """Decorator which allows a coroutine to be turned into a `starlette.routing.Route` inside a `core.View`.
 
     Parameters
@@ -100,6 +192,9 @@ def route(path: str, /, *, methods: list[str] = ["GET"], prefix: bool = True) ->
         The allowed methods for this route. Defaults to ``['GET']``.
     prefix: bool
         Whether the route path should be prefixed with the View class name. Defaults to True.
+    session: bool
+        Whether this route uses ``request.session``. Sessions are only loaded from storage for routes which set this.
+        Defaults to False.
     """
 
     def decorator(coro: Callable[[Any, Request], ResponseType]) -> _Route:
@@ -111,17 +206,22 @@ def route(path: str, /, *, methods: list[str] = ["GET"], prefix: bool = True) ->
             raise ValueError(f'Route callback function must not be named any: {", ".join(disallowed)}')
 
         limits: RateLimitData = getattr(coro, "__limits__", {})  # type: ignore
-        return _Route(path=path, coro=coro, methods=methods, prefix=prefix, limits=limits)
+        return _Route(path=path, coro=coro, methods=methods, prefix=prefix, limits=limits, session=session)
 
     return decorator
 
 
 def limit(
-    rate: int, per: int, *, bucket: Literal["ip", "user"] = "ip", exempt: ExemptCallable = None
+    rate: int,
+    per: int,
+    *,
+    bucket: Literal["ip", "user"] = "ip",
+    exempt: ExemptCallable = None,
+    backend: LimiterBackendName | None = None,
 ) -> T_LimitDecorator:
     """Decorator which allows a Route to have a rate limit.
 
-    Rate limits use the GCRA algorithm and are stored in memory.
+    Rate limits use the GCRA algorithm and are stored in memory, or in Redis when using the ``"redis"`` backend.
 
     Parameters
     ----------
@@ -131,16 +231,22 @@ def limit(
         The period in seconds.
     bucket: Literal["ip", "user"]
         The bucket to use for rate limiting. Defaults to "ip".
+        When "user", requests authenticated with an API token or a logged in session are limited per user, with
+        donators receiving ``[LIMITER] donator_multiplier`` times the rate and moderators being exempt. All other
+        requests fall back to the "ip" bucket.
     exempt: Optional[ExemptCallable]
         An awaitable which takes a `starlette.requests.Request` and returns a boolean. If this returns True, the rate
         limit is not applied. Defaults to None.
+    backend: Optional[Literal["memory", "redis"]]
+        The backend which stores this limits state. ``"redis"`` shares the limit between every worker and node.
+        Defaults to None, which uses the ``[LIMITER]`` backend from config.
     """
 
     def decorator(coro: Callable[[Any, Request], ResponseType] | _Route) -> LimitDecorator:
-        limits: RateLimitData = {"rate": rate, "per": per, "bucket": bucket, "exempt": exempt}
+        limits: RateLimitData = {"rate": rate, "per": per, "bucket": bucket, "exempt": exempt, "backend": backend}
 
         if isinstance(coro, _Route):
-            coro._limits = limits
+            coro._set_limits(limits)
         else:
             setattr(coro, "__limits__", limits)
 
@@ -280,6 +386,21 @@ class Application(Starlette):
 
         self._views.append(view)
 
+    def peek_user(self, *, token: str | None = None, uid: int | None = None) -> User | Literal[False] | None:
+        """Returns the cached user for an API token or user ID without any I/O, False when the credentials are cached
+        as invalid, or None when nothing is cached. Used by the "user" rate limit bucket before `fetch_user`.
+
+        The default implementation returns None. Subclasses which cache users should override this.
+        """
+        return None
+
+    async def fetch_user(self, *, token: str | None = None, uid: int | None = None) -> User | None:
+        """Returns the user for an API token or user ID, used by the "user" rate limit bucket.
+
+        The default implementation returns None, which limits every request by IP. Subclasses should override this.
+        """
+        return None
+
 
 class WebsocketCloseCodes:
     NORMAL: int = 1000
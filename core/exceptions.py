@@ -27,3 +27,11 @@ class URLValidationError(Exception):
     def __init__(self, *args: object, reason: str | None = None) -> None:
         self.reason = reason
         super().__init__(*args)
+
+
+class RendererSaturated(ChiiError):
+    """Exception thrown when too many QR codes are already waiting to be rendered."""
+
+    def __init__(self, *args: object, retry_after: float) -> None:
+        self.retry_after = retry_after
+        super().__init__(*args)
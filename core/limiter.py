@@ -17,57 +17,247 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 
-import datetime
+import heapq
 import logging
-from typing import TYPE_CHECKING, ClassVar
+import time
+from typing import TYPE_CHECKING, Any, ClassVar
 
-
-logger: logging.Logger = logging.getLogger(__name__)
+from .config import config
+from .sessions import redis_pool
 
 
 if TYPE_CHECKING:
-    from types_ import TatStore
+    from redis.commands.core import AsyncScript
+
+    from types_ import LimiterBackendName
+
+
+logger: logging.Logger = logging.getLogger(__name__)
 
 
 class RateLimit:
+    __slots__ = ("rate", "period", "inverse")
+
     def __init__(self, rate: int, per: int) -> None:
         self.rate: int = rate
-        self.period: datetime.timedelta = datetime.timedelta(seconds=per)
-
-    @property
-    def inverse(self) -> float:
-        return self.period.total_seconds() / self.rate
+        self.period: float = float(per)
+        self.inverse: float = self.period / rate
 
 
 class Store:
-    __keys: ClassVar[dict[str, TatStore]] = {}
+    """In-memory GCRA state.
+
+    Each key maps to its theoretical arrival time (TAT) as a `time.monotonic` float. Once the TAT has passed a key
+    holds no more information than a missing key, so keys are expired incrementally from a min-heap ordered by TAT
+    instead of scanning every key on each request. The heap holds a single entry per key; entries which have been
+    pushed back by later requests are rescheduled when they surface.
+
+    The amount of tracked keys is capped by ``[LIMITER] max_keys``. When full, the key closest to expiry is evicted.
+    """
+
+    __keys: ClassVar[dict[str, float]] = {}
+    __expiries: ClassVar[list[tuple[float, str]]] = []
+
+    max_keys: ClassVar[int] = config.get("LIMITER", {}).get("max_keys", 100_000)
+    max_expire_batch: ClassVar[int] = 64
+
+    @classmethod
+    def size(cls) -> int:
+        return len(cls.__keys)
 
     @classmethod
-    def get_tat(cls, key: str, /) -> datetime.datetime:
-        now: datetime.datetime = datetime.datetime.now(tz=datetime.UTC)
-        return cls.__keys.get(key, {"tat": now}).get("tat", now)
+    def get_tat(cls, key: str, /, *, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(cls.__keys.get(key, now), now)
 
     @classmethod
-    def set_tat(cls, key: str, /, *, tat: datetime.datetime, limit: RateLimit) -> None:
-        cls.__keys[key] = {"tat": tat, "limit": limit}
+    def set_tat(cls, key: str, /, *, tat: float) -> None:
+        if key not in cls.__keys:
+            if len(cls.__keys) >= cls.max_keys:
+                cls._evict()
+
+            heapq.heappush(cls.__expiries, (tat, key))
+
+        cls.__keys[key] = tat
+
+    @classmethod
+    def _pop(cls) -> tuple[float, str] | None:
+        # Pops the heap until an entry is found which matches its keys current TAT, rescheduling any stale entries...
+        while cls.__expiries:
+            expires, key = heapq.heappop(cls.__expiries)
+            tat: float | None = cls.__keys.get(key)
+
+            if tat is None:
+                continue
+
+            if tat > expires:
+                heapq.heappush(cls.__expiries, (tat, key))
+                continue
+
+            return expires, key
+
+        return None
+
+    @classmethod
+    def _evict(cls) -> None:
+        popped: tuple[float, str] | None = cls._pop()
+
+        if popped is not None:
+            del cls.__keys[popped[1]]
+
+    @classmethod
+    def expire(cls, now: float, /) -> None:
+        """Remove up to ``max_expire_batch`` keys whose TAT has passed."""
+        for _ in range(cls.max_expire_batch):
+            if not cls.__expiries or cls.__expiries[0][0] > now:
+                return
+
+            _, key = heapq.heappop(cls.__expiries)
+            tat: float | None = cls.__keys.get(key)
+
+            if tat is None:
+                continue
+
+            if tat > now:
+                heapq.heappush(cls.__expiries, (tat, key))
+            else:
+                del cls.__keys[key]
 
     @classmethod
     def update(cls, key: str, limit: RateLimit) -> bool | float:
-        now: datetime.datetime = datetime.datetime.now(tz=datetime.UTC)
-        tat: datetime.datetime = max(cls.get_tat(key), now)
+        now: float = time.monotonic()
+        cls.expire(now)
 
-        # Clear stale keys...
-        for ek, ev in cls.__keys.copy().items():
-            if (now - ev["tat"]).total_seconds() > ev["limit"].period.total_seconds() + 60:
-                del cls.__keys[ek]
+        tat: float = cls.get_tat(key, now=now)
 
-        separation: float = (tat - now).total_seconds()
-        max_interval: float = limit.period.total_seconds() - limit.inverse
+        separation: float = tat - now
+        max_interval: float = limit.period - limit.inverse
 
         if separation > max_interval:
             return separation - max_interval
 
-        new_tat: datetime.datetime = max(tat, now) + datetime.timedelta(seconds=limit.inverse)
-        cls.set_tat(key, tat=new_tat, limit=limit)
+        cls.set_tat(key, tat=tat + limit.inverse)
+        return False
+
+
+class MemoryBackend:
+    """Rate limit backend which keeps GCRA state in the process local `Store`."""
+
+    async def update(self, key: str, limit: RateLimit) -> bool | float:
+        return Store.update(key, limit)
+
+
+class RedisBackend:
+    """Rate limit backend which runs the GCRA check atomically in Redis, shared between every worker and node.
+
+    To avoid a Redis round trip per request, each check may lease a small batch of allowances which are then spent
+    locally for up to ``lease_ttl`` seconds. Leases are only used for limits of at least 20 requests per period and
+    never exceed 5% of the rate, so unspent leases can only ever make a limit marginally stricter.
+
+    If Redis is unavailable the check falls back to the in-memory `Store`.
+
+    Parameters
+    ----------
+    lease_size: int
+        The maximum amount of allowances leased per Redis round trip.
+    lease_ttl: float
+        The amount of seconds a lease may be spent locally for.
+    """
+
+    # Redis server time is used so nodes do not need synchronised clocks...
+    SCRIPT: str = """
+    local period = tonumber(ARGV[1])
+    local inverse = tonumber(ARGV[2])
+    local wanted = tonumber(ARGV[3])
+
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+    local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+    if tat < now then
+        tat = now
+    end
+
+    local separation = tat - now
+    local max_interval = period - inverse
+
+    if separation > max_interval then
+        return {0, tostring(separation - max_interval)}
+    end
+
+    local granted = math.min(wanted, math.floor((max_interval - separation) / inverse) + 1)
+    local new_tat = tat + granted * inverse
+
+    redis.call("SET", KEYS[1], tostring(new_tat), "PX", math.ceil((new_tat - now) * 1000))
+    return {granted, "0"}
+    """
+
+    PREFIX: str = "chii:limits:"
+
+    def __init__(self, *, lease_size: int, lease_ttl: float) -> None:
+        self.lease_size: int = max(lease_size, 1)
+        self.lease_ttl: float = lease_ttl
+
+        self._script: AsyncScript = redis_pool().register_script(self.SCRIPT)
+        self._leases: dict[str, list[float]] = {}
+
+    def _wanted(self, limit: RateLimit) -> int:
+        return max(1, min(self.lease_size, limit.rate // 20))
+
+    async def update(self, key: str, limit: RateLimit) -> bool | float:
+        now: float = time.monotonic()
+        lease: list[float] | None = self._leases.get(key)
+
+        if lease is not None:
+            if lease[0] >= 1 and lease[1] > now:
+                lease[0] -= 1
+                return False
+
+            del self._leases[key]
+
+        args: list[float] = [limit.period, limit.inverse, self._wanted(limit)]
+
+        try:
+            response: Any = await self._script(keys=[f"{self.PREFIX}{key}"], args=args)  # type: ignore
+        except Exception as e:
+            logger.warning("Unable to reach Redis for rate limiting, falling back to memory: %s", e)
+            return Store.update(key, limit)
+
+        granted: int = int(response[0])
+        if not granted:
+            return float(response[1])
+
+        if granted > 1:
+            # Leases are only an optimisation, so rather than tracking their expiry we drop them all when full...
+            if len(self._leases) >= Store.max_keys:
+                self._leases.clear()
+
+            self._leases[key] = [granted - 1, now + self.lease_ttl]
 
         return False
+
+
+_backends: dict[str, MemoryBackend | RedisBackend] = {}
+
+
+def get_backend(name: LimiterBackendName | None = None, /) -> MemoryBackend | RedisBackend:
+    """Return the rate limit backend for name, creating it on first use.
+
+    When name is None, ``[LIMITER] backend`` is used, which defaults to ``"memory"``.
+    """
+    lcfg = config.get("LIMITER", {})
+    resolved: LimiterBackendName = name or lcfg.get("backend") or "memory"
+
+    try:
+        return _backends[resolved]
+    except KeyError:
+        pass
+
+    backend: MemoryBackend | RedisBackend
+    if resolved == "redis":
+        backend = RedisBackend(lease_size=lcfg.get("lease_size", 10), lease_ttl=lcfg.get("lease_ttl", 1.0))
+    else:
+        backend = MemoryBackend()
+
+    _backends[resolved] = backend
+    return backend
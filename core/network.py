@@ -0,0 +1,117 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import functools
+import ipaddress
+import logging
+from typing import TYPE_CHECKING
+
+from .config import config
+
+
+if TYPE_CHECKING:
+    from starlette.types import Scope
+
+
+__all__ = ("client_ip",)
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+_scfg = config["SERVER"]
+
+TRUSTED_PROXIES: tuple[ipaddress.IPv4Network | ipaddress.IPv6Network, ...] = tuple(
+    ipaddress.ip_network(n, strict=False) for n in _scfg.get("trusted_proxies", ["127.0.0.1/32", "::1/128"])
+)
+IPV4_PREFIX: int = _scfg.get("ipv4_prefix", 32)
+IPV6_PREFIX: int = _scfg.get("ipv6_prefix", 64)
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse(address: str, /) -> ipaddress.IPv4Address | ipaddress.IPv6Address | None:
+    try:
+        parsed = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return None
+
+    if isinstance(parsed, ipaddress.IPv6Address) and parsed.ipv4_mapped:
+        return parsed.ipv4_mapped
+
+    return parsed
+
+
+@functools.lru_cache(maxsize=8192)
+def _trusted(address: str, /) -> bool:
+    parsed = _parse(address)
+    return parsed is not None and any(parsed in network for network in TRUSTED_PROXIES)
+
+
+@functools.lru_cache(maxsize=65536)
+def _aggregate(address: str, /) -> str | None:
+    # Returns the limiter key for an address, aggregated to the configured prefix; None for loopback addresses...
+    parsed = _parse(address)
+
+    if parsed is None:
+        return address
+
+    if parsed.is_loopback:
+        return None
+
+    prefix: int = IPV4_PREFIX if parsed.version == 4 else IPV6_PREFIX
+    if prefix >= parsed.max_prefixlen:
+        return str(parsed)
+
+    return str(ipaddress.ip_network((parsed, prefix), strict=False))
+
+
+def client_ip(scope: Scope, forwarded: str | None = None, /) -> str | None:
+    """Resolve the client address used as a rate limit key, or None when the client connected locally.
+
+    ``X-Forwarded-For`` is only honoured when the connecting peer is a trusted proxy, in which case the right-most hop
+    which is not itself a trusted proxy is the client. IPv4 and IPv6 addresses are aggregated to ``[SERVER]
+    ipv4_prefix`` and ``ipv6_prefix`` respectively, so a single IPv6 allocation can not mint unlimited keys.
+
+    Parameters
+    ----------
+    scope: Scope
+        The ASGI scope of the request.
+    forwarded: Optional[str]
+        The value of the ``X-Forwarded-For`` header, if present.
+    """
+    client: tuple[str, int] | None = scope.get("client")
+    address: str = client[0] if client else "unknown"
+
+    if forwarded and _trusted(address):
+        hops: list[str] = forwarded.split(",")
+
+        for hop in reversed(hops):
+            if _parse(hop) is None:
+                # Our own proxies always append a valid address, so anything else is the client lying. A fixed key
+                # is used, so garbage can neither mint new keys nor fall back to the exempt proxy address...
+                return "unknown"
+
+            address = hop.strip()
+            if not _trusted(address):
+                break
+
+        # A forwarded request is never local, even when every hop claims to be...
+        return _aggregate(address) or "unknown"
+
+    return _aggregate(address)
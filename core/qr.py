@@ -0,0 +1,367 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import logging
+import pathlib
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Literal
+
+import qrcode
+from qrcode.image.styledpil import StyledPilImage
+from qrcode.image.styles.colormasks import SolidFillColorMask
+from qrcode.image.styles.moduledrawers.pil import RoundedModuleDrawer
+
+from .cache import LRUCache
+from .exceptions import RendererSaturated
+
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from types_ import RendererStats
+
+
+__all__ = ("QRCache", "QRRenderer", "render_png", "render_svg")
+
+
+FRONT_COLOUR: tuple[int, int, int] = (119, 90, 165)
+BACK_COLOUR: tuple[int, int, int] = (249, 241, 239)
+BOX_SIZE: int = 10
+BORDER: int = 4
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def render_png(value: str, /) -> bytes:
+    """Render a styled QR code as PNG bytes.
+
+    This is CPU bound and holds the GIL, so should be run with `QRRenderer`.
+    """
+    qr = qrcode.QRCode(  # type: ignore
+        error_correction=qrcode.constants.ERROR_CORRECT_L,  # type: ignore
+        box_size=BOX_SIZE,
+        border=BORDER,
+    )
+
+    qr.add_data(value)  # type: ignore
+
+    img = qr.make_image(  # type: ignore
+        image_factory=StyledPilImage,
+        module_drawer=RoundedModuleDrawer(radius_ratio=1),
+        color_mask=SolidFillColorMask(front_color=FRONT_COLOUR, back_color=BACK_COLOUR),
+    )
+
+    fp: io.BytesIO = io.BytesIO()
+    img.save(fp, "PNG")  # type: ignore
+    img.close()  # type: ignore
+
+    return fp.getvalue()
+
+
+def _number(value: float, /) -> str:
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def render_svg(value: str, /) -> bytes:
+    """Render a QR code as SVG bytes, in the same colours and rounded style as `render_png`, without PIL.
+
+    Each horizontal run of dark modules becomes a single path. As with `RoundedModuleDrawer`, a corner is rounded
+    when both modules next to it are light, which can only happen at the ends of a run.
+    """
+    qr = qrcode.QRCode(  # type: ignore
+        error_correction=qrcode.constants.ERROR_CORRECT_L,  # type: ignore
+        border=BORDER,
+    )
+
+    qr.add_data(value)  # type: ignore
+    matrix: list[list[bool]] = qr.get_matrix()  # type: ignore
+
+    size: int = len(matrix)
+    r: float = 0.5
+    parts: list[str] = []
+
+    def dark(x: int, y: int) -> bool:
+        return 0 <= y < size and 0 <= x < size and matrix[y][x]
+
+    for y, row in enumerate(matrix):
+        x: int = 0
+
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+
+            start: int = x
+            while x < size and row[x]:
+                x += 1
+            end: int = x - 1
+
+            nw: float = r if not dark(start, y - 1) else 0.0
+            sw: float = r if not dark(start, y + 1) else 0.0
+            ne: float = r if not dark(end, y - 1) else 0.0
+            se: float = r if not dark(end, y + 1) else 0.0
+
+            path: list[str] = [f"M{_number(start + nw)} {y}H{_number(x - ne)}"]
+            if ne:
+                path.append("a.5.5 0 0 1 .5.5")
+            path.append(f"V{_number(y + 1 - se)}")
+            if se:
+                path.append("a.5.5 0 0 1-.5.5")
+            path.append(f"H{_number(start + sw)}")
+            if sw:
+                path.append("a.5.5 0 0 1-.5-.5")
+            path.append(f"V{_number(y + nw)}")
+            if nw:
+                path.append("a.5.5 0 0 1 .5-.5")
+
+            parts.append("".join(path) + "z")
+
+    pixels: int = size * BOX_SIZE
+    svg: str = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" viewBox="0 0 {size} {size}">'
+        f'<rect width="{size}" height="{size}" fill="rgb{BACK_COLOUR}"/>'
+        f'<path fill="rgb{FRONT_COLOUR}" d="{"".join(parts)}"/>'
+        "</svg>"
+    )
+
+    return svg.encode()
+
+
+class QRCache:
+    """Two tier cache of rendered QR codes.
+
+    Rendered images are kept in a bounded in-memory LRU and, when ``directory`` is set, written to disk under a name
+    derived from the short URL they encode. Since the image for a short URL never changes, the same key is used as a
+    strong ETag.
+
+    The directory is kept under ``max_disk_size`` bytes by deleting the oldest images first, which also clears out
+    images for redirects which have since expired or been deleted.
+
+    Parameters
+    ----------
+    max_size: int
+        The maximum amount of images kept in memory.
+    directory: Optional[str]
+        The directory to store rendered images in. Defaults to None, which only caches in memory.
+    max_disk_size: int
+        The maximum amount of bytes stored in ``directory``. Defaults to 256 MiB.
+    """
+
+    # Bump this whenever the QR style changes, so cached images and client ETags are invalidated...
+    VERSION: str = "1"
+
+    def __init__(self, *, max_size: int, directory: str | None = None, max_disk_size: int = 256 * 1024 * 1024) -> None:
+        self.memory: LRUCache[str, bytes] = LRUCache(max_size)
+        self.directory: pathlib.Path | None = pathlib.Path(directory) if directory else None
+        self.max_disk_size: int = max(max_disk_size, 0)
+
+        # Unknown until the directory is first scanned, which happens on the first write...
+        self.disk_size: int | None = None
+        self._pruning: bool = False
+
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, short: str, /, *, fmt: str = "png") -> str:
+        return hashlib.sha256(f"{self.VERSION}:{fmt}:{short}".encode()).hexdigest()
+
+    def path(self, key: str, /, *, fmt: str = "png") -> pathlib.Path | None:
+        """Returns the path to a cached image on disk, or None when it has not been stored."""
+        if not self.directory:
+            return None
+
+        path: pathlib.Path = self.directory / key[:2] / f"{key}.{fmt}"
+        return path if path.is_file() else None
+
+    def get(self, key: str, /) -> bytes | None:
+        return self.memory.get(key)
+
+    async def set(self, key: str, data: bytes, /, *, fmt: str = "png") -> None:
+        self.memory.set(key, data)
+
+        if self.directory:
+            try:
+                await asyncio.to_thread(self._write, self.directory / key[:2] / f"{key}.{fmt}", data)
+            except OSError as e:
+                logger.warning("Unable to write QR code to the disk cache: %s", e)
+                return
+
+            if self.disk_size is not None:
+                self.disk_size += len(data)
+
+            if (self.disk_size is None or self.disk_size > self.max_disk_size) and not self._pruning:
+                self._pruning = True
+
+                try:
+                    self.disk_size = await asyncio.to_thread(self._prune, self.directory)
+                except OSError as e:
+                    logger.warning("Unable to prune the QR code disk cache: %s", e)
+                finally:
+                    self._pruning = False
+
+    def _prune(self, directory: pathlib.Path, /) -> int:
+        # Deletes the oldest images until the directory is back under 90% of its limit. Returns the bytes remaining...
+        files: list[tuple[float, int, pathlib.Path]] = []
+
+        for path in directory.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total: int = sum(f[1] for f in files)
+        if total <= self.max_disk_size:
+            return total
+
+        target: int = self.max_disk_size * 9 // 10
+        removed: int = 0
+
+        for _, size, path in sorted(files, key=lambda f: f[0]):
+            if total <= target:
+                break
+
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+
+        logger.info("Pruned %s QR codes from the disk cache.", removed)
+        return total
+
+    def _write(self, path: pathlib.Path, data: bytes, /) -> None:
+        path.parent.mkdir(exist_ok=True)
+
+        # Write to a temporary file first so a partially written image is never served...
+        temp: pathlib.Path = path.with_suffix(f".{secrets.token_hex(4)}.tmp")
+        temp.write_bytes(data)
+        temp.replace(path)
+
+
+class QRRenderer:
+    """Renders QR codes in a pool of worker processes, so bursts of renders never stall the event loop.
+
+    At most ``max_pending`` renders may be queued or running at once. Further renders raise `RendererSaturated`, so
+    callers can shed load instead of piling up work.
+
+    Parameters
+    ----------
+    workers: int
+        The amount of worker processes. When 0, renders run in the default thread pool instead.
+    max_pending: int
+        The maximum amount of renders queued or running at once.
+    """
+
+    def __init__(self, *, workers: int, max_pending: int) -> None:
+        self.workers: int = max(workers, 0)
+        self.max_pending: int = max(max_pending, 1)
+        self._executor: ProcessPoolExecutor | None = ProcessPoolExecutor(self.workers) if self.workers else None
+
+        self.pending: int = 0
+        self.rendered: int = 0
+        self.rejected: int = 0
+        self.errors: int = 0
+        self.restarts: int = 0
+        self.render_time: float = 0.0
+        self.last_render_time: float = 0.0
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    @property
+    def average_render_time(self) -> float:
+        return self.render_time / self.rendered if self.rendered else 0.0
+
+    @property
+    def retry_after(self) -> float:
+        """An estimate of the seconds until the current queue has drained."""
+        return max(1.0, self.average_render_time * self.pending / (self.workers or 1))
+
+    async def render(self, value: str, /, *, fmt: Literal["png", "svg"] = "png") -> bytes:
+        if self.saturated:
+            self.rejected += 1
+            raise RendererSaturated(retry_after=self.retry_after)
+
+        started: float = time.perf_counter()
+
+        self.pending += 1
+        try:
+            renderer: Callable[[str], bytes] = render_svg if fmt == "svg" else render_png
+            data: bytes = await self._execute(renderer, value)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        self.last_render_time = time.perf_counter() - started
+        self.render_time += self.last_render_time
+        self.rendered += 1
+
+        return data
+
+    async def _execute(self, renderer: Callable[[str], bytes], value: str, /) -> bytes:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        # A dead worker breaks the whole pool, so it is replaced and the render tried once more on the new pool...
+        for _ in range(2):
+            executor: ProcessPoolExecutor | None = self._executor
+
+            try:
+                return await loop.run_in_executor(executor, renderer, value)
+            except BrokenProcessPool:
+                self._restart(executor)
+
+        raise RendererSaturated(retry_after=self.retry_after)
+
+    def _restart(self, executor: ProcessPoolExecutor | None, /) -> None:
+        # Every render running on the broken pool fails at once; only the first of them replaces it...
+        if executor is None or executor is not self._executor:
+            return
+
+        logger.warning("A QR code worker process died, replacing the worker pool.")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        self._executor = ProcessPoolExecutor(self.workers)
+        self.restarts += 1
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> RendererStats:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rendered": self.rendered,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "restarts": self.restarts,
+            "average_render_ms": round(self.average_render_time * 1000, 3),
+            "last_render_ms": round(self.last_render_time * 1000, 3),
+        }
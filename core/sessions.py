@@ -17,12 +17,17 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 
+import asyncio
 import base64
 import datetime
+import functools
 import json
 import logging
+import re
 import secrets
-from typing import TYPE_CHECKING, Any
+import zlib
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Any, Literal, Self
 
 import itsdangerous
 import redis.asyncio as redis
@@ -31,38 +36,167 @@ from starlette.requests import HTTPConnection
 
 from core import config
 
+from .cache import LRUCache, SingleFlight
+
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 
+@functools.cache
+def redis_pool() -> redis.Redis:
+    """Returns the Redis client shared by sessions and the Redis rate limit backend."""
+    rcfg = config["REDIS"]
+    pool = redis.ConnectionPool.from_url(f"redis://{rcfg['host']}:{rcfg['port']}/{rcfg['db']}")  # type: ignore
+    return redis.Redis.from_pool(pool)
+
+
 class Storage:
-    __slots__ = "pool"
+    """Redis session storage.
+
+    Reads go through a short lived, process local near-cache, and concurrent reads of the same session share a single
+    Redis GET. Writes made in the same event loop cycle are coalesced, so each session is written at most once, in one
+    pipeline.
+
+    Parameters
+    ----------
+    cache_size: int
+        The maximum amount of sessions held in the near-cache.
+    cache_ttl: float
+        The amount of seconds a session is held in the near-cache for.
+    """
+
+    __slots__ = ("pool", "cache", "_reads", "_writes", "_flushing", "_epoch")
+
+    def __init__(self, *, cache_size: int = 10000, cache_ttl: float = 2.0) -> None:
+        self.pool: redis.Redis = redis_pool()
 
-    def __init__(self) -> None:
-        rcfg = config["REDIS"]
-        pool = redis.ConnectionPool.from_url(f"redis://{rcfg['host']}:{rcfg['port']}/{rcfg['db']}")  # type: ignore
-        self.pool: redis.Redis = redis.Redis.from_pool(pool)
+        # Sessions are cached as JSON so callers always receive their own copy...
+        self.cache: LRUCache[str, str] = LRUCache(cache_size, ttl=cache_ttl)
+        self._reads: SingleFlight[str, str] = SingleFlight()
+        self._writes: dict[str, tuple[str, int] | None] = {}
+        self._flushing: asyncio.Future[None] | None = None
+        self._epoch: int = 0
 
     async def get(self, data: dict[str, Any]) -> dict[str, Any]:
         expiry: datetime.datetime = datetime.datetime.fromisoformat(data["expiry"])
         key: str = data["_session_secret_key"]
 
         if expiry <= datetime.datetime.now():
-            await self.pool.delete(key)  # type: ignore
+            await self.delete(key)
             return {}
 
-        session: Any = await self.pool.get(key)  # type: ignore
-        return json.loads(session) if session else {}
+        session: str | None = self.cache.get(key)
+        if session is None:
+            session = await self._reads.do(key, lambda: self._fetch(key))
+
+        return json.loads(session)
+
+    async def _fetch(self, key: str, /) -> str:
+        epoch: int = self._epoch
+        raw: Any = await self.pool.get(key)  # type: ignore
+        session: str = raw.decode("utf-8") if raw else "{}"
+
+        # Only cache what we read if nothing was written in the meantime...
+        if epoch == self._epoch:
+            self.cache.set(key, session)
+
+        return session
 
     async def set(self, key: str, value: dict[str, Any], *, max_age: int) -> None:
-        await self.pool.set(key, json.dumps(value), ex=max_age)  # type: ignore
+        session: str = json.dumps(value)
+
+        self._epoch += 1
+        self.cache.set(key, session)
+        self._writes[key] = (session, max_age)
+
+        await self._schedule()
 
     async def delete(self, key: str) -> None:
-        await self.pool.delete(key)  # type: ignore
+        self._epoch += 1
+        self.cache.delete(key)
+        self._writes[key] = None
+
+        await self._schedule()
+
+    async def _schedule(self) -> None:
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush())
+
+        await asyncio.shield(self._flushing)
+
+    async def _flush(self) -> None:
+        # Yield once so every write made in this cycle joins the same pipeline...
+        await asyncio.sleep(0)
+
+        writes, self._writes = self._writes, {}
+        self._flushing = None
+
+        async with self.pool.pipeline(transaction=False) as pipe:  # type: ignore
+            for key, write in writes.items():
+                if write is None:
+                    pipe.delete(key)  # type: ignore
+                else:
+                    pipe.set(key, write[0], ex=write[1])  # type: ignore
+
+            await pipe.execute()  # type: ignore
+
+
+class LazySession(MutableMapping[str, Any]):
+    """Session mapping which is only loaded from storage when a handler asks for it.
+
+    Requests without a session cookie start with an empty, loaded session. Otherwise the cookie is only decoded and the
+    session fetched once `load` is awaited, which `core.route(..., session=True)` does before calling the route.
+    """
+
+    __slots__ = ("_middleware", "_cookie", "_data", "original")
+
+    def __init__(self, middleware: SessionMiddleware, cookie: str | None) -> None:
+        self._middleware: SessionMiddleware = middleware
+        self._cookie: str | None = cookie
+        self._data: dict[str, Any] | None = None if cookie else {}
+        self.original: dict[str, Any] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self._data is not None
+
+    async def load(self) -> Self:
+        if self._data is None:
+            self._data = await self._middleware.load(self._cookie)
+            self.original = self._data.copy()
+
+        return self
+
+    @property
+    def data(self) -> dict[str, Any]:
+        if self._data is None:
+            raise RuntimeError("This session has not been loaded. Use core.route(..., session=True).")
+
+        return self._data
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.data[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def clear(self) -> None:
+        self.data.clear()
 
 
 class SessionMiddleware:
@@ -75,6 +209,12 @@ class SessionMiddleware:
         max_age: int | None = None,
         same_site: str = "lax",
         secure: bool = True,
+        bypass: list[str] | None = None,
+        backend: Literal["redis", "cookie"] = "redis",
+        cookie_max_size: int = 3800,
+        compress: bool = True,
+        cache_size: int = 10000,
+        cache_ttl: float = 2.0,
     ) -> None:
         self.app: ASGIApp = app
         self.name: str = name or "__session_cookie"
@@ -83,53 +223,105 @@ class SessionMiddleware:
         )  # set this if you don't want to invalidate sessions on restart
         self.max_age: int = max_age or (60 * 60 * 24 * 7)  # 7 days; 1 week
         self.signing: itsdangerous.Signer = itsdangerous.Signer(self.secret)
-        self.storage: Storage = Storage()
+        self.storage: Storage = Storage(cache_size=cache_size, cache_ttl=cache_ttl)
+
+        # The "cookie" backend keeps the session in the signed cookie itself, falling back to Redis when too large...
+        self.backend: Literal["redis", "cookie"] = backend
+        self.cookie_max_size: int = cookie_max_size
+        self.compress: bool = compress
+
+        # Requests to these paths never get a session...
+        self.bypass: re.Pattern[str] | None = re.compile("|".join(f"(?:{p})" for p in bypass)) if bypass else None
 
         self.flags: str = f"HttpOnly; SameSite={same_site}; Path=/{'; secure' if secure else ''}"
 
+    async def load(self, cookie: str | None, /) -> dict[str, Any]:
+        if not cookie:
+            return {}
+
+        try:
+            unsigned: str = self.signing.unsign(base64.b64decode(cookie.encode("utf-8"))).decode("utf-8")
+            data: dict[str, Any] = json.loads(unsigned)
+
+            if "data" not in data and "z" not in data:
+                return await self.storage.get(data)
+
+            if datetime.datetime.fromisoformat(data["expiry"]) <= datetime.datetime.now():
+                return {}
+
+            if "z" in data:
+                return json.loads(zlib.decompress(base64.b64decode(data["z"])))
+
+            return data["data"]
+        except (KeyError, ValueError, zlib.error, itsdangerous.BadSignature):
+            return {}
+
+    def sign(self, data: dict[str, Any], /) -> str:
+        return base64.b64encode(self.signing.sign(json.dumps(data, separators=(",", ":")))).decode("utf-8")
+
+    def pack(self, data: dict[str, Any], /, *, expiry: datetime.datetime) -> str | None:
+        """Returns a signed cookie holding the session data, or None when it would exceed the cookie budget."""
+        payload: str = json.dumps(data, separators=(",", ":"))
+        cookie_: dict[str, Any] = {"expiry": expiry.isoformat(), "data": data}
+
+        if self.compress and len(payload) > 128:
+            compressed: bytes = zlib.compress(payload.encode("utf-8"), 9)
+
+            if len(compressed) < len(payload):
+                cookie_ = {"expiry": expiry.isoformat(), "z": base64.b64encode(compressed).decode("utf-8")}
+
+        signed: str = self.sign(cookie_)
+        return signed if len(signed) <= self.cookie_max_size else None
+
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        if scope["type"] not in ("http", "websocket"):
+        if scope["type"] not in ("http", "websocket") or (self.bypass and self.bypass.match(scope["path"])):
             await self.app(scope, receive, send)
             return
 
         # Use this to cover both websocket connections and http connections
         connection: HTTPConnection = HTTPConnection(scope, receive)
-        session: dict[str, Any]
 
-        try:
-            cookie: bytes = connection.cookies[self.name].encode("utf-8")
-            unsigned: str = self.signing.unsign(base64.b64decode(cookie)).decode("utf-8")
-            data: dict[str, Any] = json.loads(unsigned)
-            session = await self.storage.get(data)
-        except (KeyError, itsdangerous.BadSignature):
-            session = {}
-
-        original: dict[str, Any] = session.copy()
+        session: LazySession = LazySession(self, connection.cookies.get(self.name))
         scope["session"] = session
 
         async def wrapper(message: Message) -> None:
-            if message["type"] != "http.response.start":
+            # Nothing can have changed if the session was never loaded...
+            if message["type"] != "http.response.start" or not session.loaded:
                 await send(message)
                 return
 
             headers: MutableHeaders = MutableHeaders(scope=message)
-            secret_key: str = scope["session"].get("_session_secret_key", secrets.token_urlsafe(64))
+            original: dict[str, Any] = session.original
+
+            stored: str | None = original.get("_session_secret_key")
 
             # At this point we can assume that the server has cleared the session...
-            if not scope["session"] and original:
-                await self.storage.delete(original["_session_secret_key"])
+            if not session and original:
+                if stored:
+                    await self.storage.delete(stored)
+
                 headers.append("Set-Cookie", self.cookies(value="null", clear=True))
 
             # Server has updated the session data so we need to set a new cookie...
-            elif scope["session"] != original:
+            elif session.data != original:
                 expiry = datetime.datetime.now() + datetime.timedelta(seconds=self.max_age)
-                scope["session"]["_session_secret_key"] = secret_key
+                value: str | None = None
+
+                if self.backend == "cookie":
+                    session.pop("_session_secret_key", None)
+                    value = self.pack(session.data, expiry=expiry)
+
+                    if value and stored:
+                        await self.storage.delete(stored)
+
+                if value is None:
+                    secret_key: str = stored or secrets.token_urlsafe(64)
+                    session["_session_secret_key"] = secret_key
 
-                cookie_: dict[str, str] = {"_session_secret_key": secret_key, "expiry": expiry.isoformat()}
-                signed: bytes = base64.b64encode(self.signing.sign(json.dumps(cookie_)))
-                headers.append("Set-Cookie", self.cookies(value=signed.decode("utf-8")))
+                    value = self.sign({"_session_secret_key": secret_key, "expiry": expiry.isoformat()})
+                    await self.storage.set(secret_key, session.data, max_age=self.max_age)
 
-                await self.storage.set(secret_key, scope["session"], max_age=self.max_age)
+                headers.append("Set-Cookie", self.cookies(value=value))
 
             await send(message)
 
@@ -0,0 +1,93 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import hashlib
+import urllib.parse
+from typing import Any
+
+from validators import ValidationError  # type: ignore
+from validators.url import url as URLVALIDATOR  # type: ignore
+
+from .config import config
+from .exceptions import URLValidationError
+
+
+__all__ = ("location_digest", "normalize_url", "validate_url")
+
+
+DEFAULT_PORTS: dict[str, int] = {"http": 80, "https": 443}
+
+
+def validate_url(__value: Any, /) -> str:
+    """Validate a URL which is about to be shortened, raising `URLValidationError` when it is not allowed.
+
+    This is a plain function, rather than living on the API view, so it can also be used from worker processes.
+    """
+    options: dict[str, bool] = {
+        "skip_ipv6_addr": True,
+        "skip_ipv4_addr": True,
+    }
+
+    out: ValidationError | bool = URLVALIDATOR(__value, **options)
+    if isinstance(out, ValidationError):
+        raise URLValidationError from out
+
+    if out is not True:
+        raise URLValidationError
+
+    domain: str = config["DOMAIN"]["name"]
+
+    if domain in __value:
+        raise URLValidationError(f"Can not contain the domain: {domain}")
+
+    max_: int = config["OPTIONS"]["max_url_length"]
+    min_: int = config["OPTIONS"]["min_url_length"]
+    len_: int = len(__value)
+
+    if len_ > max_:
+        raise URLValidationError(reason=f"The provided URL exceeds the maximum length of ({max_})")
+    elif len_ < min_:
+        raise URLValidationError(reason=f"The provided URL must be over ({min_}) characters long")
+
+    return __value
+
+
+def normalize_url(value: str, /) -> str:
+    """Normalize a URL without changing where it leads.
+
+    The scheme and host are lowercased and default ports are dropped. The path, query and fragment are kept as they
+    are, since servers are free to treat them case sensitively.
+    """
+    parts: urllib.parse.SplitResult = urllib.parse.urlsplit(value.strip())
+    scheme: str = parts.scheme.lower()
+    userinfo, _, address = parts.netloc.rpartition("@")
+    address = address.lower()
+
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and int(port) == DEFAULT_PORTS.get(scheme):
+        address = host
+
+    netloc: str = f"{userinfo}@{address}" if userinfo else address
+
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def location_digest(value: str, /) -> bytes:
+    """A 16 byte digest of the normalized URL, used to find existing redirects to the same location."""
+    return hashlib.sha256(normalize_url(value).encode()).digest()[:16]
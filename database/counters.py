@@ -0,0 +1,154 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime
+import logging
+import time
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from .database import Database
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """Write-behind buffer for redirect views.
+
+    Views are accumulated in memory per redirect and UTC hour, and written back in one transaction with a single
+    batched UPDATE of the totals and a single batched upsert into ``redirect_views_hourly``, either every ``interval``
+    seconds or as soon as ``threshold`` distinct redirects are pending, whichever comes first.
+
+    Parameters
+    ----------
+    database: Database
+        The database to flush views to.
+    interval: float
+        The maximum amount of seconds between flushes.
+    threshold: int
+        The amount of distinct pending redirects which triggers an early flush.
+    """
+
+    def __init__(self, database: Database, *, interval: float, threshold: int) -> None:
+        self.database: Database = database
+        self.interval: float = interval
+        self.threshold: int = max(threshold, 1)
+
+        # Maps each identifier to its pending views, keyed by the unix timestamp of the hour they happened in...
+        self._pending: dict[str, dict[int, int]] = {}
+        self._flushing: dict[str, dict[int, int]] = {}
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._lock: asyncio.Lock = asyncio.Lock()
+        self._task: asyncio.Task[None] | None = None
+
+    def add(self, identifier: str, amount: int = 1, /, *, hour: int | None = None) -> None:
+        if hour is None:
+            hour = int(time.time()) // 3600 * 3600
+
+        hours: dict[int, int] | None = self._pending.get(identifier)
+        if hours is None:
+            hours = self._pending[identifier] = {}
+
+        hours[hour] = hours.get(hour, 0) + amount
+
+        if len(self._pending) >= self.threshold:
+            self._wakeup.set()
+
+    def pending(self, identifier: str, /) -> int:
+        """Returns the amount of views for a redirect which have not yet been written to the database."""
+        return sum(self._pending.get(identifier, {}).values()) + sum(self._flushing.get(identifier, {}).values())
+
+    def pending_hours(self, identifier: str, /) -> dict[int, int]:
+        """Returns the views for a redirect which have not yet been written to the database, keyed by hour."""
+        hours: dict[int, int] = dict(self._flushing.get(identifier, {}))
+
+        for hour, amount in self._pending.get(identifier, {}).items():
+            hours[hour] = hours.get(hour, 0) + amount
+
+        return hours
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+
+            self._flushing, self._pending = self._pending, {}
+
+            # Sorting keeps the row lock order consistent between concurrent flushes from other workers...
+            identifiers: list[str] = sorted(self._flushing)
+            deltas: list[int] = [sum(self._flushing[i].values()) for i in identifiers]
+
+            keys: list[str] = []
+            hours: list[datetime.datetime] = []
+            counts: list[int] = []
+
+            for identifier in identifiers:
+                for hour, amount in sorted(self._flushing[identifier].items()):
+                    keys.append(identifier)
+                    hours.append(datetime.datetime.fromtimestamp(hour, tz=datetime.UTC))
+                    counts.append(amount)
+
+            try:
+                async with self.database.acquire() as connection:
+                    async with connection.transaction():
+                        await (await connection.prepared("add_views")).fetch(identifiers, deltas)
+                        await (await connection.prepared("add_hourly_views")).fetch(keys, hours, counts)
+
+                    # The views are committed; stop reporting them as pending before the connection is released...
+                    self._flushing = {}
+            except Exception as e:
+                if self._flushing:
+                    logger.warning(
+                        "Unable to flush views for %s redirects, retrying next flush: %s", len(identifiers), e
+                    )
+
+                for identifier, pending in self._flushing.items():
+                    for hour, amount in pending.items():
+                        self.add(identifier, amount, hour=hour)
+            finally:
+                self._flushing = {}
+
+    async def close(self) -> None:
+        if self._task is not None:
+            # Holding the lock guarantees we never cancel the task part way through a flush...
+            async with self._lock:
+                self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+        await self.flush()
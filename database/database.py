@@ -18,20 +18,33 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import datetime
 import logging
 import re
 import secrets
-import string
-from typing import TYPE_CHECKING, Any, Self, cast
+import time
+from typing import TYPE_CHECKING, Any, Literal, Self, cast
 
 import asyncpg
 
 import core
 from types_ import Redirect
 
+from .counters import ViewCounter
+from .exports import export_redirects
+from .filters import KnownIdentifiers
+from .identifiers import IdentifierPool
+from .queries import Connection
+from .replicas import CONNECTION_ERRORS, ReplicaSet
+from .rollups import ViewRollup
+from .sweeper import ExpirySweeper
+
 
 if TYPE_CHECKING:
-    from types_ import BasicRedirect
+    from collections.abc import AsyncGenerator, AsyncIterator
+
+    from types_ import BasicRedirect, DatabaseMetrics, ExportFormat, PoolMetrics, SeriesKind, User, ViewSeries
 
     _Pool = asyncpg.Pool[asyncpg.Record]
 else:
@@ -41,17 +54,93 @@ else:
 logger: logging.Logger = logging.getLogger(__name__)
 
 EMAIL_VALIDATE: re.Pattern[str] = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b")
-ALPHABET: str = string.ascii_letters + string.digits
+
+
+def _deadline(expiry: datetime.datetime | None) -> float | None:
+    # Converts a redirects expiry into a time.monotonic deadline for the in-memory caches...
+    if expiry is None:
+        return None
+
+    remaining: float = (expiry - datetime.datetime.now(tz=datetime.UTC)).total_seconds()
+    return time.monotonic() + remaining
 
 
 class Database:
     pool: _Pool
 
+    def __init__(self) -> None:
+        dcfg = core.config["DATABASE"]
+        ccfg = core.config.get("CACHE", {})
+        icfg = core.config.get("IDENTIFIERS", {})
+
+        self.redirect_cache: core.LRUCache[str, str] = core.LRUCache(
+            ccfg.get("redirects_max_size", 10000), ttl=ccfg.get("redirects_ttl", 3600)
+        )
+        # Invalid tokens are cached as False so they can not be used to hammer the database...
+        self.user_cache: core.LRUCache[str, User | Literal[False]] = core.LRUCache(
+            ccfg.get("users_max_size", 10000), ttl=ccfg.get("users_ttl", 60)
+        )
+        self.views: ViewCounter = ViewCounter(
+            self, interval=dcfg.get("views_flush_interval", 10), threshold=dcfg.get("views_flush_threshold", 1000)
+        )
+        self.identifiers: IdentifierPool = IdentifierPool(
+            self,
+            scheme=icfg.get("scheme", "random"),
+            length=icfg.get("length", 8),
+            size=icfg.get("pool_size", 512),
+            permute=icfg.get("permute", True),
+            secret=icfg.get("secret", ""),
+        )
+        self.sweeper: ExpirySweeper = ExpirySweeper(
+            self, interval=dcfg.get("sweep_interval", 60), batch_size=dcfg.get("sweep_batch_size", 1000)
+        )
+        self.rollup: ViewRollup = ViewRollup(
+            self,
+            retention=dcfg.get("views_hourly_retention", 7),
+            interval=dcfg.get("views_rollup_interval", 3600),
+            batch_size=dcfg.get("views_rollup_batch_size", 5000),
+        )
+        self.known: KnownIdentifiers = KnownIdentifiers(
+            self,
+            bloom=ccfg.get("bloom", False),
+            capacity=ccfg.get("bloom_capacity", 1000000),
+            error_rate=ccfg.get("bloom_error_rate", 0.01),
+            missing_size=ccfg.get("missing_max_size", 100000),
+            missing_ttl=ccfg.get("missing_ttl", 60),
+        )
+        self.dedupe: bool = core.config["OPTIONS"].get("dedupe", False)
+        # Maps location digests to the identifier of an anonymous redirect to that location...
+        self.recent_locations: core.LRUCache[bytes, str] = core.LRUCache(ccfg.get("locations_max_size", 10000))
+        self.creating: core.SingleFlight[bytes, Redirect | None] = core.SingleFlight()
+        # Concurrent lookups of the same identifier share one query, so a viral link can not drain the pool...
+        self.lookups: core.SingleFlight[str, asyncpg.Record | None] = core.SingleFlight()
+        self.replicas: ReplicaSet = ReplicaSet(interval=dcfg.get("replica_check_interval", 5))
+        self.max_id_attempts: int = max(icfg.get("max_attempts", 5), 1)
+
+        self.acquires: int = 0
+        self.waiting: int = 0
+        self.acquire_wait: float = 0.0
+        self.max_acquire_wait: float = 0.0
+
     async def __aenter__(self) -> Self:
         await self.setup()
         return self
 
     async def __aexit__(self, *args: Any) -> None:
+        await self.known.close()
+        await self.sweeper.close()
+        await self.rollup.close()
+        await self.identifiers.close()
+
+        try:
+            await asyncio.wait_for(self.views.close(), 10)
+        except TimeoutError:
+            logger.warning("Timed-out trying to flush pending views during shutdown.")
+        except Exception as e:
+            logger.warning("Unable to flush pending views during shutdown: %s.", e)
+
+        await self.replicas.close()
+
         try:
             await asyncio.wait_for(self.pool.close(), 10)
         except TimeoutError:
@@ -59,8 +148,24 @@ class Database:
         except Exception as e:
             logger.debug("Database encountered an error shutting down: %s.", e)
 
+    def _pool_options(self) -> dict[str, Any]:
+        dcfg = core.config["DATABASE"]
+
+        return {
+            "min_size": dcfg.get("min_size", 2),
+            "max_size": dcfg.get("max_size", 10),
+            "max_queries": dcfg.get("max_queries", 50000),
+            "max_inactive_connection_lifetime": dcfg.get("max_inactive_connection_lifetime", 300),
+            "statement_cache_size": dcfg.get("statement_cache_size", 100),
+            "server_settings": dcfg.get("server_settings", {"application_name": "chii"}),
+            "connection_class": Connection,
+            "init": self._init_connection,
+        }
+
     async def setup(self) -> Self:
-        pool: _Pool | None = await asyncpg.create_pool(dsn=core.config["DATABASE"]["dsn"])
+        dcfg = core.config["DATABASE"]
+
+        pool: _Pool | None = await asyncpg.create_pool(dsn=dcfg["dsn"], **self._pool_options())
 
         if pool is None:
             raise RuntimeError("Unable to create a Database Connection Pool.")
@@ -71,12 +176,139 @@ class Database:
         self.pool = pool
         await self._initial_user()
 
+        # Replicas are connected after the schema has been applied to the primary...
+        await self.replicas.connect(dcfg.get("replica_dsns", []), **self._pool_options())
+
+        self.views.start()
+        self.identifiers.start()
+        self.replicas.start()
+        self.known.start()
+
         logger.info("Successfully started Database.")
 
         return self
 
+    async def _init_connection(self, connection: asyncpg.Connection[asyncpg.Record]) -> None:
+        # Runs once for every new connection in the pool...
+        init_sql: str = core.config["DATABASE"].get("init_sql", "")
+
+        if init_sql:
+            await connection.execute(init_sql)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, pool: _Pool | None = None) -> AsyncGenerator[Connection]:
+        """Acquire a connection from the primary, or the given pool, recording how long we waited for it."""
+        pool = pool or self.pool
+        started: float = time.perf_counter()
+
+        self.waiting += 1
+        try:
+            connection: Any = await pool.acquire()
+        finally:
+            self.waiting -= 1
+
+        waited: float = time.perf_counter() - started
+        self.acquires += 1
+        self.acquire_wait += waited
+        self.max_acquire_wait = max(self.max_acquire_wait, waited)
+
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+
+    async def fetchrow(self, name: str, /, *args: Any) -> asyncpg.Record | None:
+        """Run a named read-only query on a healthy replica, falling back to the primary.
+
+        Replicas lag behind the primary, so when a replica finds no row the primary is asked as well. This keeps
+        freshly created redirects and users visible everywhere straight away.
+        """
+        replica: _Pool | None = self.replicas.choose()
+
+        if replica is not None:
+            try:
+                async with self.acquire(pool=replica) as connection:
+                    row: asyncpg.Record | None = await (await connection.prepared(name)).fetchrow(*args)
+            except CONNECTION_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+            else:
+                if row is not None:
+                    return row
+
+        async with self.acquire() as connection:
+            return await (await connection.prepared(name)).fetchrow(*args)
+
+    async def fetch_identifiers(self, name: str, identifiers: list[str], /) -> list[asyncpg.Record]:
+        """Run a named read-only query taking an array of identifiers on a healthy replica.
+
+        As with `fetchrow`, any identifiers the replica has no row for are asked of the primary as well.
+        """
+        rows: list[asyncpg.Record] = []
+        missing: list[str] = identifiers
+        replica: _Pool | None = self.replicas.choose()
+
+        if replica is not None:
+            try:
+                async with self.acquire(pool=replica) as connection:
+                    rows = await (await connection.prepared(name)).fetch(identifiers)
+            except CONNECTION_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+            else:
+                found: set[str] = {r["id"] for r in rows}
+                missing = [i for i in identifiers if i not in found]
+
+        if missing:
+            async with self.acquire() as connection:
+                rows.extend(await (await connection.prepared(name)).fetch(missing))
+
+        return rows
+
+    async def fetch(self, name: str, /, *args: Any) -> list[asyncpg.Record]:
+        """Run a named read-only query on a healthy replica, falling back to the primary when the replica is down.
+
+        Unlike `fetchrow`, an empty result from a replica is trusted, so this should only be used for data where a
+        little replication lag is acceptable.
+        """
+        replica: _Pool | None = self.replicas.choose()
+
+        if replica is not None:
+            try:
+                async with self.acquire(pool=replica) as connection:
+                    return await (await connection.prepared(name)).fetch(*args)
+            except CONNECTION_ERRORS as e:
+                self.replicas.mark_down(replica, e)
+
+        async with self.acquire() as connection:
+            return await (await connection.prepared(name)).fetch(*args)
+
+    def pool_metrics(self) -> PoolMetrics:
+        size: int = self.pool.get_size()
+        idle: int = self.pool.get_idle_size()
+
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "waiting": self.waiting,
+            "acquires": self.acquires,
+            "average_acquire_ms": round(self.acquire_wait / self.acquires * 1000, 3) if self.acquires else 0.0,
+            "max_acquire_ms": round(self.max_acquire_wait * 1000, 3),
+        }
+
+    def metrics(self) -> DatabaseMetrics:
+        return {
+            "redirect_cache": self.redirect_cache.stats(),
+            "user_cache": self.user_cache.stats(),
+            "pool": self.pool_metrics(),
+            "replicas": self.replicas.metrics(),
+            "coalesced_lookups": self.lookups.shared,
+            "filter": self.known.metrics(),
+        }
+
     async def _initial_user(self) -> None:
-        async with self.pool.acquire() as connection:
+        async with self.acquire() as connection:
             count: int = await connection.fetchval("""SELECT count(*) FROM users""")
 
             if count > 0:
@@ -105,45 +337,242 @@ class Database:
             INSERT INTO users(email, moderator, token)
             VALUES($1, $2, $3)
             """
-            async with self.pool.acquire() as connection:
+            async with self.acquire() as connection:
                 await connection.execute(query, "__ADMIN__", True, token)
 
             print(f"\n\n----START ADMIN ACCOUNT TOKEN----\n\n{token}\n\n----END ADMIN ACCOUNT TOKEN------\n\n")
             logger.info("Successfully created the ADMIN ACCOUNT.")
 
+    def peek_user(self, *, token: str | None = None, uid: int | None = None) -> User | Literal[False] | None:
+        """Returns the cached user for an API token or user ID without querying the database.
+
+        False is returned for credentials which are cached as invalid, and None when nothing is cached.
+        """
+        key: str = f"token:{token}" if token is not None else f"uid:{uid}"
+        return self.user_cache.peek(key)
+
+    async def fetch_user(self, *, token: str | None = None, uid: int | None = None) -> User | None:
+        name: str
+        value: str | int | None
+
+        if token is not None:
+            name, value = "fetch_user_by_token", token
+        else:
+            name, value = "fetch_user_by_id", uid
+
+        key: str = f"{'token' if token is not None else 'uid'}:{value}"
+        cached: User | Literal[False] | None = self.user_cache.get(key)
+
+        if cached is not None:
+            return cached or None
+
+        row: asyncpg.Record | None = await self.fetchrow(name, value)
+
+        user: User | None = cast("User", dict(row)) if row else None
+        self.user_cache.set(key, user or False)
+
+        return user
+
     async def create_redirect(self, data: BasicRedirect) -> Redirect | None:
-        query: str = """
-        INSERT INTO redirects(id, uid, expiry, location) VALUES($1, $2, $3, $4) RETURNING *
+        """Create a redirect.
+
+        With ``[OPTIONS] dedupe`` enabled, anonymous creates without an expiry return the existing anonymous redirect
+        to the same normalized location when there is one, instead of inserting a new row.
         """
-        identifier: str = "".join(secrets.choice(ALPHABET) for _ in range(8))
-        async with self.pool.acquire() as connection:
-            row: asyncpg.Record | None = await connection.fetchrow(
-                query, identifier, data["uid"], data["expiry"], data["location"]
-            )
+        if not self.dedupe or data["uid"] is not None or data["expiry"] is not None:
+            return await self._insert_redirect(data)
+
+        digest: bytes = core.location_digest(data["location"])
+        return await self.creating.do(digest, lambda: self._reuse_redirect(data, digest))
+
+    async def _reuse_redirect(self, data: BasicRedirect, digest: bytes, /) -> Redirect | None:
+        identifier: str | None = self.recent_locations.get(digest)
+        row: Redirect | None = await self.retrieve_redirect(identifier) if identifier else None
+
+        if row is None:
+            record: asyncpg.Record | None = await self.fetchrow("fetch_redirect_by_digest", digest)
+            row = cast(Redirect, record) if record else None
+
+        if row is None:
+            row = await self._insert_redirect(data, digest=digest)
+
+        if row is not None:
+            self.recent_locations.set(digest, row["id"])
+
+        return row
+
+    async def _insert_redirect(self, data: BasicRedirect, /, *, digest: bytes | None = None) -> Redirect | None:
+        row: asyncpg.Record | None = None
+
+        async with self.acquire() as connection:
+            statement = await connection.prepared("create_redirect")
+
+            for _ in range(self.max_id_attempts):
+                identifier: str = await self.identifiers.next(connection=connection)
+
+                try:
+                    row = await statement.fetchrow(identifier, data["uid"], data["expiry"], data["location"], digest)
+                except asyncpg.UniqueViolationError:
+                    logger.debug("Identifier %s is already in use, retrying with another.", identifier)
+                    continue
+
+                break
+            else:
+                logger.error("Unable to find an unused identifier after %s attempts.", self.max_id_attempts)
 
         if not row:
             return
 
+        await self.known.created(row["id"])
+
         response: Redirect = cast(Redirect, row)
         return response
 
+    async def create_redirects(self, data: list[BasicRedirect]) -> list[Redirect | None]:
+        """Create many redirects in as few round trips as possible.
+
+        Returns the created redirects in the same order as ``data``, with None for any which could not be created.
+        Rows whose identifier was already taken are retried together with fresh identifiers.
+        """
+        results: list[Redirect | None] = [None] * len(data)
+        remaining: list[int] = list(range(len(data)))
+
+        async with self.acquire() as connection:
+            statement = await connection.prepared("create_redirects")
+
+            for _ in range(self.max_id_attempts):
+                if not remaining:
+                    break
+
+                # Duplicate identifiers in one batch are left for the next attempt...
+                batch: dict[str, int] = {}
+                identifiers: list[str] = await self.identifiers.take(len(remaining), connection=connection)
+                for identifier, index in zip(identifiers, remaining):
+                    batch.setdefault(identifier, index)
+
+                rows: list[asyncpg.Record] = await statement.fetch(
+                    list(batch),
+                    [data[i]["uid"] for i in batch.values()],
+                    [data[i]["expiry"] for i in batch.values()],
+                    [data[i]["location"] for i in batch.values()],
+                )
+
+                for row in rows:
+                    results[batch[row["id"]]] = cast(Redirect, row)
+
+                remaining = [i for i in remaining if results[i] is None]
+
+        if remaining:
+            logger.error("Unable to find unused identifiers for %s redirects.", len(remaining))
+
+        await self.known.created(*(r["id"] for r in results if r))
+        return results
+
     async def retrieve_redirect(self, identifier: str, *, plus: bool = False) -> Redirect | None:
-        query: str
-        if plus:
-            query = """
-            UPDATE redirects
-            SET views = views + 1
-            WHERE id = $1
-            RETURNING *
-            """
-        else:
-            query = """SELECT * FROM redirects WHERE id = $1"""
+        if self.known.definitely_missing(identifier):
+            return
 
-        async with self.pool.acquire() as connection:
-            row: asyncpg.Record | None = await connection.fetchrow(query, identifier)
+        row: asyncpg.Record | None = await self.lookups.do(identifier, lambda: self._lookup(identifier))
 
         if not row:
             return
 
+        if plus:
+            self.views.add(identifier)
+
         response: Redirect = cast(Redirect, row)
         return response
+
+    async def _lookup(self, identifier: str, /) -> asyncpg.Record | None:
+        # The epoch is read when the query starts, rather than when each coalesced caller joins...
+        epoch: int = self.known.epoch
+        row: asyncpg.Record | None = await self.fetchrow("fetch_redirect", identifier)
+
+        if not row:
+            self.known.miss(identifier, epoch=epoch)
+
+        return row
+
+    async def retrieve_redirects(self, identifiers: list[str]) -> dict[str, Redirect]:
+        """Retrieve many redirects with a single query. Identifiers which do not exist are left out."""
+        wanted: list[str] = [i for i in dict.fromkeys(identifiers) if not self.known.definitely_missing(i)]
+        if not wanted:
+            return {}
+
+        epoch: int = self.known.epoch
+        rows: list[asyncpg.Record] = await self.fetch_identifiers("fetch_redirects", wanted)
+        found: dict[str, Redirect] = {r["id"]: cast(Redirect, r) for r in rows}
+
+        for identifier in wanted:
+            if identifier not in found:
+                self.known.miss(identifier, epoch=epoch)
+
+        return found
+
+    async def view_series(
+        self, identifiers: list[str], /, *, kind: SeriesKind = "hourly", span: int = 48
+    ) -> dict[str, ViewSeries]:
+        """Retrieve view time series for many redirects with a single query, including views not yet flushed.
+
+        Parameters
+        ----------
+        identifiers: list[str]
+            The redirects to retrieve series for.
+        kind: Literal["hourly", "daily"]
+            The bucket size. Hourly series only cover the hours kept by `database.rollups.ViewRollup`.
+        span: int
+            The amount of most recent buckets to cover, including the current one.
+        """
+        now: datetime.datetime = datetime.datetime.now(tz=datetime.UTC)
+        hourly: bool = kind == "hourly"
+        rows: list[asyncpg.Record]
+
+        if hourly:
+            start: datetime.datetime = now.replace(minute=0, second=0, microsecond=0)
+            start -= datetime.timedelta(hours=span - 1)
+            rows = await self.fetch("fetch_hourly_views", identifiers, start)
+        else:
+            first: datetime.date = now.date() - datetime.timedelta(days=span - 1)
+            start = datetime.datetime.combine(first, datetime.time(), tzinfo=datetime.UTC)
+            rows = await self.fetch("fetch_daily_views", identifiers, first)
+
+        # Buckets are keyed by a datetime for hourly series and a date for daily series...
+        buckets: dict[str, dict[datetime.date, int]] = {i: {} for i in identifiers}
+        for row in rows:
+            buckets[row["id"]][row["hour" if hourly else "day"]] = row["views"]
+
+        for identifier, series in buckets.items():
+            for hour, amount in self.views.pending_hours(identifier).items():
+                at: datetime.datetime = datetime.datetime.fromtimestamp(hour, tz=datetime.UTC)
+                if at < start:
+                    continue
+
+                key: datetime.date = at if hourly else at.date()
+                series[key] = series.get(key, 0) + amount
+
+        return {i: [(k.isoformat(), v) for k, v in sorted(series.items())] for i, series in buckets.items()}
+
+    async def export_redirects(self, *, fmt: ExportFormat = "ndjson", chunk_size: int = 1000) -> AsyncIterator[bytes]:
+        """Stream every redirect, from a replica when one is healthy. See `database.exports.export_redirects`."""
+        async with self.acquire(pool=self.replicas.choose()) as connection:
+            async for chunk in export_redirects(connection, fmt=fmt, chunk_size=chunk_size):
+                yield chunk
+
+    async def resolve_redirect(self, identifier: str) -> str | None:
+        """Resolve a short identifier to its location and count the view.
+
+        Locations are served from the in-memory redirect cache when possible. Views are buffered and written back in
+        batches by `database.counters.ViewCounter`.
+        """
+        location: str | None = self.redirect_cache.get(identifier)
+
+        if location is not None:
+            self.views.add(identifier)
+            return location
+
+        row: Redirect | None = await self.retrieve_redirect(identifier, plus=True)
+        if not row:
+            return
+
+        self.redirect_cache.set(identifier, row["location"], expires=_deadline(row["expiry"]))
+        return row["location"]
@@ -0,0 +1,84 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import csv
+import io
+import json
+from typing import TYPE_CHECKING, Any
+
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    import asyncpg
+
+    from types_ import ExportFormat
+
+    from .queries import Connection
+
+
+__all__ = ("COLUMNS", "export_redirects")
+
+
+COLUMNS: tuple[str, ...] = ("id", "uid", "expiry", "location", "views")
+
+
+def _row(record: asyncpg.Record, /) -> dict[str, Any]:
+    data: dict[str, Any] = dict(record)
+    data["expiry"] = data["expiry"].isoformat() if data["expiry"] else None
+
+    return data
+
+
+def _ndjson(records: list[asyncpg.Record], /) -> bytes:
+    return "".join(json.dumps(_row(r), separators=(",", ":")) + "\n" for r in records).encode()
+
+
+def _csv(records: list[asyncpg.Record] | None, /) -> bytes:
+    # Passing None writes the header row...
+    fp: io.StringIO = io.StringIO()
+    writer = csv.writer(fp)
+
+    if records is None:
+        writer.writerow(COLUMNS)
+    else:
+        writer.writerows([row[c] for c in COLUMNS] for row in map(_row, records))
+
+    return fp.getvalue().encode()
+
+
+async def export_redirects(
+    connection: Connection, /, *, fmt: ExportFormat = "ndjson", chunk_size: int = 1000
+) -> AsyncIterator[bytes]:
+    """Stream every redirect as NDJSON or CSV, ``chunk_size`` rows at a time.
+
+    Rows are read through a server-side cursor inside a read-only, repeatable read transaction, so the export is a
+    consistent snapshot and memory use stays constant however large the table is.
+    """
+    encode = _csv if fmt == "csv" else _ndjson
+
+    async with connection.transaction(isolation="repeatable_read", readonly=True):
+        statement = await connection.prepared("export_redirects")
+        cursor = await statement.cursor()
+
+        if fmt == "csv":
+            yield _csv(None)
+
+        while records := await cursor.fetch(chunk_size):
+            yield encode(records)
@@ -0,0 +1,241 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from typing import TYPE_CHECKING, Any
+
+import core
+from core.sessions import redis_pool
+
+
+if TYPE_CHECKING:
+    from types_ import FilterMetrics
+
+    from .database import Database
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class KnownIdentifiers:
+    """Answers "does this short identifier definitely not exist?" without a database round trip.
+
+    Identifiers which were looked up and not found are kept in a negative cache. When ``bloom`` is enabled, a
+    `core.BloomFilter` of every identifier is also built at startup by streaming ``redirects.id`` from the primary.
+    Whenever either is in use, creates on every worker are broadcast over Redis, so each workers filter and negative
+    cache learn about new identifiers straight away.
+
+    Both are only trusted while the broadcast subscription is alive. Whenever it drops, the negative cache is cleared
+    and the filter is discarded and rebuilt from scratch once Redis is reachable again, so a missed broadcast can
+    never hide a real redirect.
+
+    Parameters
+    ----------
+    database: Database
+        The database to build the filter from.
+    bloom: bool
+        Whether to build and use the Bloom filter.
+    capacity: int
+        The amount of identifiers the Bloom filter is sized for.
+    error_rate: float
+        The Bloom filters target false positive rate.
+    missing_size: int
+        The maximum amount of unknown identifiers kept in the negative cache.
+    missing_ttl: float
+        The amount of seconds an unknown identifier is cached for.
+    """
+
+    CHANNEL: str = "chii:redirects:created"
+    # Published instead of an identifier when redirects were added behind our back, e.g. by importer.py...
+    RESET: str = "*"
+
+    def __init__(
+        self,
+        database: Database,
+        *,
+        bloom: bool,
+        capacity: int,
+        error_rate: float,
+        missing_size: int,
+        missing_ttl: float,
+    ) -> None:
+        self.database: Database = database
+        self.enabled: bool = bloom
+        self.capacity: int = capacity
+        self.error_rate: float = error_rate
+
+        self.missing: core.LRUCache[str, bool] = core.LRUCache(missing_size, ttl=missing_ttl)
+        self.bloom: core.BloomFilter | None = None
+        self.rejected: int = 0
+
+        # Creates only need broadcasting when there is a filter or a negative cache to keep up to date...
+        self.broadcast: bool = bloom or self.missing.max_size > 0
+        self.subscribed: bool = False
+        # Bumped whenever identifiers are learned or forgotten, so lookups which raced a create are not cached...
+        self.epoch: int = 0
+
+        self._building: core.BloomFilter | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    def definitely_missing(self, identifier: str, /) -> bool:
+        if not self.subscribed:
+            return False
+
+        if self.missing.get(identifier) or (self.bloom is not None and identifier not in self.bloom):
+            self.rejected += 1
+            return True
+
+        return False
+
+    def miss(self, identifier: str, /, *, epoch: int) -> None:
+        """Record an identifier which was not found by a lookup started at ``epoch``.
+
+        The miss is only cached when no identifiers were learned while the lookup ran, since a create which committed
+        part way through may already have been broadcast.
+        """
+        if self.subscribed and epoch == self.epoch:
+            self.missing.set(identifier, True)
+
+    async def created(self, *identifiers: str) -> None:
+        """Record newly created identifiers, locally and on every other worker."""
+        for identifier in identifiers:
+            self._learn(identifier)
+
+        if not self.broadcast or not identifiers:
+            return
+
+        try:
+            async with redis_pool().pipeline(transaction=False) as pipe:  # type: ignore
+                for identifier in identifiers:
+                    pipe.publish(self.CHANNEL, identifier)  # type: ignore
+
+                await pipe.execute()  # type: ignore
+        except Exception as e:
+            logger.warning("Unable to broadcast %s new identifiers: %s", len(identifiers), e)
+
+    @classmethod
+    async def reset(cls) -> None:
+        """Tell every worker to forget its negative cache and rebuild its filter from the table."""
+        await redis_pool().publish(cls.CHANNEL, cls.RESET)  # type: ignore
+
+    def _learn(self, identifier: str, /) -> None:
+        self.epoch += 1
+        self.missing.delete(identifier)
+
+        if self.bloom is not None:
+            self.bloom.add(identifier)
+
+        if self._building is not None:
+            self._building.add(identifier)
+
+    def start(self) -> None:
+        if self.broadcast and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception as e:
+                logger.warning("Identifier filter disabled until Redis is reachable again: %s", e)
+
+            self.subscribed = False
+            self.epoch += 1
+            self.missing.clear()
+            self.bloom = None
+            self._building = None
+
+            await asyncio.sleep(5)
+
+    async def _listen(self) -> None:
+        async with redis_pool().pubsub() as pubsub:  # type: ignore
+            # Subscribe before building, so nothing created while we stream the table is missed...
+            await pubsub.subscribe(self.CHANNEL)  # type: ignore
+            self.subscribed = True
+
+            build: asyncio.Task[None] | None = asyncio.create_task(self._build()) if self.enabled else None
+
+            try:
+                async for message in pubsub.listen():  # type: ignore
+                    if message["type"] != "message":  # type: ignore
+                        continue
+
+                    data: Any = message["data"]  # type: ignore
+                    identifier: str = data.decode() if isinstance(data, bytes) else str(data)  # type: ignore
+
+                    if identifier == self.RESET:
+                        self.epoch += 1
+                        self.missing.clear()
+
+                        if build is not None:
+                            self.bloom = None
+
+                            build.cancel()
+                            build = asyncio.create_task(self._build())
+
+                        continue
+
+                    self._learn(identifier)
+            finally:
+                self.subscribed = False
+
+                if build is not None:
+                    build.cancel()
+
+    async def _build(self) -> None:
+        bloom: core.BloomFilter = core.BloomFilter(self.capacity, error_rate=self.error_rate)
+        self._building = bloom
+
+        try:
+            async with self.database.acquire() as connection, connection.transaction():
+                statement = await connection.prepared("scan_identifiers")
+
+                async for record in statement.cursor(prefetch=1000):
+                    bloom.add(record[0])
+        except Exception as e:
+            logger.warning("Unable to build the identifier filter: %s", e)
+            return
+        finally:
+            if self._building is bloom:
+                self._building = None
+
+        self.bloom = bloom
+        logger.info("Built the identifier filter with %s identifiers.", len(bloom))
+
+    def metrics(self) -> FilterMetrics:
+        return {
+            "enabled": self.enabled,
+            "subscribed": self.subscribed,
+            "ready": self.bloom is not None,
+            "identifiers": len(self.bloom) if self.bloom is not None else 0,
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+            "missing_cache": self.missing.stats(),
+        }
@@ -0,0 +1,266 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import math
+import secrets
+import string
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from types_ import IdentifierScheme
+
+    from .database import Database
+    from .queries import Connection
+
+
+__all__ = ("ALPHABET", "FeistelPermutation", "IdentifierPool", "encode")
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+ALPHABET: str = string.ascii_letters + string.digits
+
+
+def encode(value: int, /, *, length: int) -> str:
+    """Encode a non-negative integer as a fixed length base62 string."""
+    base: int = len(ALPHABET)
+    chars: list[str] = []
+
+    for _ in range(length):
+        value, index = divmod(value, base)
+        chars.append(ALPHABET[index])
+
+    return "".join(reversed(chars))
+
+
+class FeistelPermutation:
+    """A keyed, format preserving permutation of the integers ``0 <= n < limit``.
+
+    A balanced Feistel network over the smallest even amount of bits covering ``limit``, with cycle walking to stay in
+    range. Since it is a bijection, distinct counter values always map to distinct outputs, while consecutive values
+    map to outputs which can not be predicted without the key.
+
+    Parameters
+    ----------
+    key: bytes
+        The secret key. Every process generating identifiers must use the same key.
+    limit: int
+        The size of the domain.
+    rounds: int
+        The amount of Feistel rounds. Defaults to 4.
+    """
+
+    __slots__ = ("_key", "limit", "rounds", "_half", "_mask")
+
+    def __init__(self, key: bytes, *, limit: int, rounds: int = 4) -> None:
+        self._key: bytes = hashlib.blake2b(key, digest_size=32, person=b"chii-ids").digest()
+        self.limit: int = limit
+        self.rounds: int = rounds
+
+        bits: int = max(math.ceil(math.log2(limit)), 2)
+        self._half: int = (bits + 1) // 2
+        self._mask: int = (1 << self._half) - 1
+
+    def _round(self, index: int, value: int, /) -> int:
+        digest: bytes = hashlib.blake2b(
+            value.to_bytes(8, "big") + index.to_bytes(1, "big"), key=self._key, digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") & self._mask
+
+    def _permute(self, value: int, /) -> int:
+        left, right = value >> self._half, value & self._mask
+
+        for index in range(self.rounds):
+            left, right = right, left ^ self._round(index, right)
+
+        return (left << self._half) | right
+
+    def __call__(self, value: int, /) -> int:
+        if not 0 <= value < self.limit:
+            raise ValueError(f"Value must be in the range 0 <= value < {self.limit}.")
+
+        # Cycle walking; re-permute until we land back inside the domain...
+        value = self._permute(value)
+        while value >= self.limit:
+            value = self._permute(value)
+
+        return value
+
+
+class IdentifierPool:
+    """Generates short URL identifiers ahead of time, so creating a redirect never waits on ID generation.
+
+    With the ``"random"`` scheme, identifiers are drawn with `secrets`. With the ``"sequence"`` scheme, blocks of
+    values are reserved from the ``redirect_ids`` Postgres sequence in one round trip and encoded to base62. Sequence
+    identifiers can never collide with each other, and unless ``permute`` is disabled they are passed through a keyed
+    `FeistelPermutation` so they can not be guessed. Unpermuted identifiers are sequential, which keeps inserts at the
+    right edge of the primary key index, but makes every short URL trivially enumerable.
+
+    The pool is refilled in the background once it drops below half of ``size``.
+
+    Parameters
+    ----------
+    database: Database
+        The database to reserve sequence values from.
+    scheme: Literal["random", "sequence"]
+        The identifier scheme.
+    length: int
+        The amount of characters in each identifier.
+    size: int
+        The amount of identifiers kept ready.
+    permute: bool
+        Whether sequence values are permuted. Ignored for the ``"random"`` scheme.
+    secret: str
+        The permutation key. Required when sequence values are permuted.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        *,
+        scheme: IdentifierScheme,
+        length: int,
+        size: int,
+        permute: bool,
+        secret: str,
+    ) -> None:
+        if scheme not in ("random", "sequence"):
+            raise ValueError(f'Unknown identifier scheme "{scheme}". Expected "random" or "sequence".')
+
+        sequential: bool = scheme == "sequence"
+        if sequential and permute and not secret:
+            raise ValueError(
+                "[IDENTIFIERS] secret must be set to use permuted sequence identifiers, or anyone could enumerate them."
+            )
+
+        self.database: Database = database
+        self.scheme: IdentifierScheme = scheme
+        self.length: int = length
+        self.size: int = max(size, 1)
+        self.limit: int = len(ALPHABET) ** length
+        self.permutation: FeistelPermutation | None = (
+            FeistelPermutation(secret.encode(), limit=self.limit) if sequential and permute else None
+        )
+
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=self.size)
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+    async def next(self, *, connection: Connection | None = None) -> str:
+        """Return an unused identifier, generating one directly if the pool is empty.
+
+        Callers already holding a connection must pass it, so generating never waits on a second one from the pool.
+        """
+        try:
+            identifier: str = self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            self._wakeup.set()
+            return (await self.generate(1, connection=connection))[0]
+
+        if self._queue.qsize() < self.size // 2:
+            self._wakeup.set()
+
+        return identifier
+
+    async def take(self, amount: int, /, *, connection: Connection | None = None) -> list[str]:
+        """Return ``amount`` unused identifiers, generating whatever the pool can not cover in one go.
+
+        As with `next`, callers already holding a connection must pass it.
+        """
+        identifiers: list[str] = []
+
+        while len(identifiers) < amount:
+            try:
+                identifiers.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        self._wakeup.set()
+
+        if len(identifiers) < amount:
+            identifiers.extend(await self.generate(amount - len(identifiers), connection=connection))
+
+        return identifiers
+
+    async def generate(self, amount: int, /, *, connection: Connection | None = None) -> list[str]:
+        if self.scheme == "random":
+            return ["".join(secrets.choice(ALPHABET) for _ in range(self.length)) for _ in range(amount)]
+
+        if connection is not None:
+            return await self._reserve(connection, amount)
+
+        async with self.database.acquire() as connection:
+            return await self._reserve(connection, amount)
+
+    async def _reserve(self, connection: Connection, amount: int, /) -> list[str]:
+        statement = await connection.prepared("reserve_identifiers")
+        values: list[int] = [r[0] for r in await statement.fetch(amount)]
+
+        return [self._encode(v) for v in values]
+
+    def _encode(self, value: int, /) -> str:
+        value %= self.limit
+
+        if self.permutation:
+            value = self.permutation(value)
+
+        return encode(value, length=self.length)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            missing: int = self.size - self._queue.qsize()
+            if missing <= 0:
+                continue
+
+            try:
+                identifiers: list[str] = await self.generate(missing)
+            except Exception as e:
+                logger.warning("Unable to refill the identifier pool: %s", e)
+
+                await asyncio.sleep(1)
+                self._wakeup.set()
+                continue
+
+            for identifier in identifiers:
+                try:
+                    self._queue.put_nowait(identifier)
+                except asyncio.QueueFull:
+                    break
@@ -0,0 +1,119 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import datetime
+import json
+import re
+from typing import TYPE_CHECKING, Any, TypeAlias, cast
+
+from core.exceptions import URLValidationError
+from core.validation import validate_url
+
+
+if TYPE_CHECKING:
+    import asyncpg
+
+    from .queries import Connection
+
+
+__all__ = ("COLUMNS", "ImportFailure", "ImportRow", "load_rows", "parse_rows")
+
+
+# Imported identifiers must stay routable as /{id}, and skip sessions via the default [SESSIONS] bypass...
+IDENTIFIER: re.Pattern[str] = re.compile(r"^[A-Za-z0-9]{1,64}$")
+COLUMNS: tuple[str, ...] = ("line", "id", "expiry", "location", "views")
+
+# line, id, expiry, location, views...
+ImportRow: TypeAlias = tuple[int, str, datetime.datetime | None, str, int]
+# line, id, reason...
+ImportFailure: TypeAlias = tuple[int, str | None, str]
+
+
+def _parse(line: int, raw: dict[str, Any] | str, now: datetime.datetime, /) -> ImportRow:
+    data: Any = json.loads(raw) if isinstance(raw, str) else raw
+
+    if not isinstance(data, dict):
+        raise ValueError("Expected an object with id, location and optionally expiry and views")
+
+    fields: dict[str, Any] = cast("dict[str, Any]", data)
+
+    identifier: Any = fields.get("id")
+    if not isinstance(identifier, str) or not IDENTIFIER.match(identifier):
+        raise ValueError("The id must be 1 to 64 letters or digits")
+
+    location: Any = fields.get("location")
+    if not isinstance(location, str):
+        raise ValueError("Missing location")
+
+    try:
+        validate_url(location)
+    except URLValidationError as e:
+        raise ValueError(e.reason or str(e) or "An incorrect, invalid or improper URL was passed") from e
+
+    raw_expiry: Any = fields.get("expiry")
+    expiry: datetime.datetime | None = None
+
+    if raw_expiry:
+        expiry = datetime.datetime.fromisoformat(str(raw_expiry))
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=datetime.UTC)
+
+        if expiry <= now:
+            raise ValueError("Already expired")
+
+    views: int = int(fields.get("views") or 0)
+    return line, identifier, expiry, location, max(views, 0)
+
+
+def parse_rows(batch: list[tuple[int, dict[str, Any] | str]], /) -> tuple[list[ImportRow], list[ImportFailure]]:
+    """Parse and validate a batch of rows, each either a CSV row as a dict or an NDJSON line.
+
+    This is CPU bound and runs in worker processes. Returns the valid rows and an error for each invalid row.
+    """
+    now: datetime.datetime = datetime.datetime.now(tz=datetime.UTC)
+    rows: list[ImportRow] = []
+    errors: list[ImportFailure] = []
+
+    for line, raw in batch:
+        try:
+            rows.append(_parse(line, raw, now))
+        except Exception as e:
+            identifier: Any = raw.get("id") if isinstance(raw, dict) else None
+            errors.append((line, identifier if isinstance(identifier, str) else None, str(e)))
+
+    return rows, errors
+
+
+async def load_rows(connection: Connection, rows: list[ImportRow], /) -> list[ImportFailure]:
+    """Load validated rows with COPY, returning a conflict for every row whose id was already taken.
+
+    Rows are copied into a temporary staging table, then moved into ``redirects`` with a single ``INSERT ... ON
+    CONFLICT DO NOTHING``. When an id appears more than once in a batch, the first line wins.
+    """
+    async with connection.transaction():
+        await connection.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS import_staging "
+            "(line BIGINT, id TEXT, expiry TIMESTAMPTZ, location TEXT, views BIGINT) ON COMMIT DELETE ROWS"
+        )
+        await connection.copy_records_to_table("import_staging", records=rows, columns=COLUMNS)
+
+        statement = await connection.prepared("import_redirects")
+        conflicts: list[asyncpg.Record] = await statement.fetch()
+
+    return [(r["line"], r["id"], "The id is already in use") for r in conflicts]
@@ -0,0 +1,170 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+import asyncpg
+
+
+if TYPE_CHECKING:
+    from asyncpg.prepared_stmt import PreparedStatement
+
+    _Connection = asyncpg.Connection[asyncpg.Record]
+else:
+    _Connection = asyncpg.Connection
+
+
+__all__ = ("QUERIES", "Connection")
+
+
+# Every query run on the hot path lives here, so it is prepared once per connection and reused...
+QUERIES: dict[str, str] = {
+    "fetch_redirect": """
+    SELECT id, uid, expiry, location, views FROM redirects
+    WHERE id = $1 AND (expiry IS NULL OR expiry > now())
+    """,
+    "fetch_redirects": """
+    SELECT id, uid, expiry, location, views FROM redirects
+    WHERE id = ANY($1::text[]) AND (expiry IS NULL OR expiry > now())
+    """,
+    "fetch_redirect_by_digest": """
+    SELECT id, uid, expiry, location, views FROM redirects
+    WHERE digest = $1 AND uid IS NULL AND expiry IS NULL
+    LIMIT 1
+    """,
+    "create_redirect": """
+    INSERT INTO redirects(id, uid, expiry, location, digest) VALUES($1, $2, $3, $4, $5)
+    RETURNING id, uid, expiry, location, views
+    """,
+    "create_redirects": """
+    INSERT INTO redirects(id, uid, expiry, location)
+    SELECT * FROM unnest($1::text[], $2::bigint[], $3::timestamptz[], $4::text[])
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id, uid, expiry, location, views
+    """,
+    "fetch_user_by_token": """
+    SELECT * FROM users WHERE token = $1
+    """,
+    "fetch_user_by_id": """
+    SELECT * FROM users WHERE id = $1
+    """,
+    "add_views": """
+    UPDATE redirects AS r
+    SET views = r.views + v.delta
+    FROM unnest($1::text[], $2::bigint[]) AS v(id, delta)
+    WHERE r.id = v.id
+    """,
+    "add_hourly_views": """
+    INSERT INTO redirect_views_hourly(id, hour, views)
+    SELECT v.id, v.hour, v.delta FROM unnest($1::text[], $2::timestamptz[], $3::bigint[]) AS v(id, hour, delta)
+    JOIN redirects AS r ON r.id = v.id
+    ON CONFLICT (id, hour) DO UPDATE SET views = redirect_views_hourly.views + EXCLUDED.views
+    """,
+    "fetch_hourly_views": """
+    SELECT id, hour, views FROM redirect_views_hourly
+    WHERE id = ANY($1::text[]) AND hour >= $2
+    """,
+    "fetch_daily_views": """
+    SELECT id, day, sum(views)::bigint AS views FROM (
+        SELECT id, day, views FROM redirect_views_daily
+        WHERE id = ANY($1::text[]) AND day >= $2
+        UNION ALL
+        SELECT id, (hour AT TIME ZONE 'UTC')::date, views FROM redirect_views_hourly
+        WHERE id = ANY($1::text[]) AND hour >= $2::timestamp AT TIME ZONE 'UTC'
+    ) AS v
+    GROUP BY id, day
+    """,
+    "rollup_views": """
+    WITH moved AS (
+        DELETE FROM redirect_views_hourly
+        WHERE (id, hour) IN (
+            SELECT id, hour FROM redirect_views_hourly
+            WHERE hour < $1
+            ORDER BY hour
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, hour, views
+    ), rolled AS (
+        INSERT INTO redirect_views_daily(id, day, views)
+        SELECT id, (hour AT TIME ZONE 'UTC')::date, sum(views) FROM moved
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (id, day) DO UPDATE SET views = redirect_views_daily.views + EXCLUDED.views
+    )
+    SELECT count(*) FROM moved
+    """,
+    "sweep_expired": """
+    WITH expired AS (
+        DELETE FROM redirects
+        WHERE id IN (
+            SELECT id FROM redirects
+            WHERE expiry IS NOT NULL AND expiry <= now()
+            ORDER BY expiry
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    ), hourly AS (
+        DELETE FROM redirect_views_hourly WHERE id IN (SELECT id FROM expired)
+    ), daily AS (
+        DELETE FROM redirect_views_daily WHERE id IN (SELECT id FROM expired)
+    )
+    SELECT id FROM expired
+    """,
+    "scan_identifiers": """
+    SELECT id FROM redirects
+    """,
+    "export_redirects": """
+    SELECT id, uid, expiry, location, views FROM redirects
+    """,
+    "import_redirects": """
+    WITH chosen AS (
+        SELECT DISTINCT ON (id) line, id, expiry, location, views FROM import_staging ORDER BY id, line
+    ), inserted AS (
+        INSERT INTO redirects(id, expiry, location, views)
+        SELECT id, expiry, location, views FROM chosen
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+    )
+    SELECT s.line, s.id FROM import_staging AS s
+    WHERE NOT EXISTS (SELECT 1 FROM chosen AS c JOIN inserted AS i ON i.id = c.id WHERE c.line = s.line)
+    ORDER BY s.line
+    """,
+    "reserve_identifiers": """
+    SELECT nextval('redirect_ids') FROM generate_series(1, $1)
+    """,
+}
+
+
+class Connection(_Connection):
+    """The connection class used by the pool, which prepares named queries from `QUERIES` on first use."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.statements: dict[str, PreparedStatement[asyncpg.Record]] = {}
+
+    async def prepared(self, name: str, /) -> PreparedStatement[asyncpg.Record]:
+        statement: PreparedStatement[asyncpg.Record] | None = self.statements.get(name)
+
+        if statement is None:
+            statement = await self.prepare(QUERIES[name])
+            self.statements[name] = statement
+
+        return statement
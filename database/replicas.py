@@ -0,0 +1,159 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from typing import TYPE_CHECKING, Any
+
+import asyncpg
+
+
+if TYPE_CHECKING:
+    from types_ import ReplicaMetrics
+
+    _Pool = asyncpg.Pool[asyncpg.Record]
+else:
+    _Pool = asyncpg.Pool
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+# Errors which mean a replica is unreachable, rather than a problem with the query itself...
+CONNECTION_ERRORS: tuple[type[BaseException], ...] = (
+    OSError,
+    TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+class ReplicaSet:
+    """Connection pools for read replicas, handed out round-robin while healthy.
+
+    A replica is marked down as soon as a query on it fails to connect, and is checked with ``SELECT 1`` every
+    ``interval`` seconds until it answers again. When no replica is healthy `choose` returns None and reads go to the
+    primary.
+
+    Parameters
+    ----------
+    interval: float
+        The amount of seconds between health checks.
+    timeout: float
+        The amount of seconds a health check may take before the replica is considered down.
+    """
+
+    def __init__(self, *, interval: float, timeout: float = 2.0) -> None:
+        self.interval: float = interval
+        self.timeout: float = timeout
+
+        self.pools: list[_Pool] = []
+        self.dsns: dict[_Pool, str] = {}
+        self.healthy: list[_Pool] = []
+        self.fallbacks: int = 0
+
+        self._index: int = 0
+        self._task: asyncio.Task[None] | None = None
+
+    async def connect(self, dsns: list[str], /, **options: Any) -> None:
+        for dsn in dsns:
+            try:
+                pool: _Pool | None = await asyncpg.create_pool(dsn=dsn, **options)
+            except Exception as e:
+                # Start without any open connections and let the health check bring it up later...
+                logger.warning("Unable to connect to read replica %s, marking it down: %s", self._host(dsn), e)
+                lazy: dict[str, Any] = {**options, "min_size": 0}
+                pool = await asyncpg.create_pool(dsn=dsn, **lazy)
+                healthy: bool = False
+            else:
+                healthy = True
+
+            if pool is None:
+                continue
+
+            self.pools.append(pool)
+            self.dsns[pool] = dsn
+
+            if healthy:
+                self.healthy.append(pool)
+
+        if self.pools:
+            logger.info("Connected to %s of %s read replicas.", len(self.healthy), len(self.pools))
+
+    def _host(self, dsn: str, /) -> str:
+        # Never log credentials...
+        return dsn.rpartition("@")[2]
+
+    def choose(self) -> _Pool | None:
+        if not self.healthy:
+            return None
+
+        self._index = (self._index + 1) % len(self.healthy)
+        return self.healthy[self._index]
+
+    def mark_down(self, pool: _Pool, error: BaseException, /) -> None:
+        self.fallbacks += 1
+
+        if pool in self.healthy:
+            self.healthy.remove(pool)
+            logger.warning("Read replica %s is down, falling back: %s", self._host(self.dsns[pool]), error)
+
+    def start(self) -> None:
+        if self._task is None and self.pools:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+        for pool in self.pools:
+            try:
+                await asyncio.wait_for(pool.close(), 10)
+            except Exception as e:
+                logger.debug("Read replica encountered an error shutting down: %s.", e)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(*(self.check(pool) for pool in self.pools))
+
+    async def check(self, pool: _Pool, /) -> bool:
+        try:
+            await asyncio.wait_for(pool.fetchval("SELECT 1"), self.timeout)
+        except Exception as e:
+            if pool in self.healthy:
+                self.mark_down(pool, e)
+
+            return False
+
+        if pool not in self.healthy:
+            self.healthy.append(pool)
+            logger.info("Read replica %s is back up.", self._host(self.dsns[pool]))
+
+        return True
+
+    def metrics(self) -> ReplicaMetrics:
+        return {"total": len(self.pools), "healthy": len(self.healthy), "fallbacks": self.fallbacks}
@@ -0,0 +1,108 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import datetime
+import logging
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from .database import Database
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class ViewRollup:
+    """Periodically rolls hourly view counts older than ``retention`` days up into daily buckets.
+
+    Each batch moves at most ``batch_size`` rows from ``redirect_views_hourly`` into ``redirect_views_daily`` with a
+    single statement, so hours are never counted twice or lost part way through. Rows locked by another worker's
+    rollup are skipped rather than waited on.
+
+    Parameters
+    ----------
+    database: Database
+        The database to roll up.
+    retention: int
+        The amount of days hourly counts are kept for.
+    interval: float
+        The amount of seconds between rollups.
+    batch_size: int
+        The maximum amount of hourly rows moved per statement.
+    """
+
+    def __init__(self, database: Database, *, retention: int, interval: float, batch_size: int) -> None:
+        self.database: Database = database
+        self.retention: int = max(retention, 1)
+        self.interval: float = interval
+        self.batch_size: int = max(batch_size, 1)
+
+        self.rolled: int = 0
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.rollup()
+            except Exception as e:
+                logger.warning("Unable to roll up hourly views: %s", e)
+
+            await asyncio.sleep(self.interval)
+
+    async def rollup(self) -> int:
+        """Move every hourly count older than the retention into its daily bucket. Returns the amount of rows moved."""
+        # Only whole UTC days are rolled up, so a day is never split between both tables for long...
+        today: datetime.date = datetime.datetime.now(tz=datetime.UTC).date()
+        cutoff: datetime.datetime = datetime.datetime.combine(
+            today - datetime.timedelta(days=self.retention), datetime.time(), tzinfo=datetime.UTC
+        )
+        total: int = 0
+
+        while True:
+            async with self.database.acquire() as connection:
+                moved: int = await (await connection.prepared("rollup_views")).fetchval(cutoff, self.batch_size)
+
+            total += moved
+            if moved < self.batch_size:
+                break
+
+            # Give other queries a turn on the pool between batches...
+            await asyncio.sleep(0)
+
+        if total:
+            self.rolled += total
+            logger.info("Rolled up %s hourly view counts into daily buckets.", total)
+
+        return total
@@ -0,0 +1,103 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from .database import Database
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    """Periodically deletes expired redirects.
+
+    Rows are deleted in batches of at most ``batch_size``, each in its own short transaction, using the partial index
+    on ``redirects.expiry``. Rows locked by another transaction, or another worker's sweeper, are skipped rather than
+    waited on.
+
+    Parameters
+    ----------
+    database: Database
+        The database to sweep.
+    interval: float
+        The amount of seconds between sweeps.
+    batch_size: int
+        The maximum amount of rows deleted per statement.
+    """
+
+    def __init__(self, database: Database, *, interval: float, batch_size: int) -> None:
+        self.database: Database = database
+        self.interval: float = interval
+        self.batch_size: int = max(batch_size, 1)
+
+        self.deleted: int = 0
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning("Unable to sweep expired redirects: %s", e)
+
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """Delete every currently expired redirect, one batch at a time. Returns the amount deleted."""
+        total: int = 0
+
+        while True:
+            async with self.database.acquire() as connection:
+                statement = await connection.prepared("sweep_expired")
+                identifiers: list[str] = [r["id"] for r in await statement.fetch(self.batch_size)]
+
+            for identifier in identifiers:
+                self.database.redirect_cache.delete(identifier)
+
+            total += len(identifiers)
+            if len(identifiers) < self.batch_size:
+                break
+
+            # Give other queries a turn on the pool between batches...
+            await asyncio.sleep(0)
+
+        if total:
+            self.deleted += total
+            logger.info("Deleted %s expired redirects.", total)
+
+        return total
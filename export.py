@@ -0,0 +1,68 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Export every redirect as NDJSON or CSV, without starting the server.
+
+    python export.py --format csv --output redirects.csv
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import sys
+from typing import BinaryIO
+
+import asyncpg
+
+import core
+from database.exports import export_redirects
+from database.queries import Connection
+
+
+config = core.config
+core.setup_logging(level=logging.INFO)
+
+logger: logging.Logger = logging.getLogger("export")
+
+
+parser = argparse.ArgumentParser(description="Export every redirect as NDJSON or CSV.")
+parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+parser.add_argument("--output", default="-", help="The file to write to. Defaults to stdout.")
+parser.add_argument("--chunk-size", type=int, default=1000, help="The amount of rows fetched per round trip.")
+parser.add_argument("--dsn", default=None, help="The database to export from. Defaults to [DATABASE] dsn.")
+
+
+async def main(args: argparse.Namespace) -> None:
+    dsn: str = args.dsn or config["DATABASE"]["dsn"]
+    connection: Connection = await asyncpg.connect(dsn=dsn, connection_class=Connection)
+
+    with contextlib.ExitStack() as stack:
+        fp: BinaryIO = sys.stdout.buffer if args.output == "-" else stack.enter_context(open(args.output, "wb"))
+        rows: int = 0
+
+        try:
+            async for chunk in export_redirects(connection, fmt=args.format, chunk_size=args.chunk_size):
+                fp.write(chunk)
+                rows += chunk.count(b"\n")
+        finally:
+            await connection.close()
+
+    # CSV includes a header line...
+    logger.info("Exported %s redirects.", rows - 1 if args.format == "csv" else rows)
+
+
+asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,133 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Import existing short URLs from CSV (with an id, location and optional expiry and views header) or NDJSON, such as
+the output of export.py. Every row which is not imported is written to the report as NDJSON with its line and reason.
+
+    python importer.py links.csv --report rejected.ndjson
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import csv
+import json
+import logging
+import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, TextIO
+
+import asyncpg
+
+import core
+from database.filters import KnownIdentifiers
+from database.imports import ImportFailure, ImportRow, load_rows, parse_rows
+from database.queries import Connection
+
+
+config = core.config
+logger: logging.Logger = logging.getLogger("importer")
+
+
+parser = argparse.ArgumentParser(description="Import existing short URLs from CSV or NDJSON.")
+parser.add_argument("input", help="The CSV or NDJSON file to import.")
+parser.add_argument("--format", choices=("csv", "ndjson"), default=None, help="Defaults to the file extension.")
+parser.add_argument("--report", default="-", help="Where to write rows which were not imported. Defaults to stderr.")
+parser.add_argument("--batch-size", type=int, default=10000, help="The amount of rows per COPY.")
+parser.add_argument("--workers", type=int, default=4, help="The amount of processes validating rows.")
+parser.add_argument("--dsn", default=None, help="The database to import into. Defaults to [DATABASE] dsn.")
+
+
+def read_batches(fp: TextIO, fmt: str, size: int, /) -> Iterator[list[tuple[int, dict[str, Any] | str]]]:
+    batch: list[tuple[int, dict[str, Any] | str]] = []
+    rows: Iterator[dict[str, Any] | str] = csv.DictReader(fp) if fmt == "csv" else (line for line in fp if line.strip())
+
+    # Line numbers start at 2 for CSV, after the header...
+    for line, row in enumerate(rows, start=2 if fmt == "csv" else 1):
+        batch.append((line, row))
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+async def main(args: argparse.Namespace) -> None:
+    fmt: str = args.format or ("csv" if args.input.endswith(".csv") else "ndjson")
+    dsn: str = args.dsn or config["DATABASE"]["dsn"]
+
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    connection: Connection = await asyncpg.connect(dsn=dsn, connection_class=Connection)
+
+    imported: int = 0
+    rejected: int = 0
+    started: float = time.perf_counter()
+
+    with contextlib.ExitStack() as stack:
+        fp: TextIO = stack.enter_context(open(args.input, newline="", encoding="utf-8"))
+        report: TextIO = sys.stderr if args.report == "-" else stack.enter_context(open(args.report, "w"))
+        executor: ProcessPoolExecutor = stack.enter_context(ProcessPoolExecutor(max(args.workers, 1)))
+
+        def write(failures: list[ImportFailure], /) -> None:
+            for line, identifier, reason in failures:
+                report.write(json.dumps({"line": line, "id": identifier, "error": reason}) + "\n")
+
+        # Keep a few batches validating ahead of the one being copied, so neither side waits on the other...
+        pending: collections.deque[asyncio.Future[tuple[list[ImportRow], list[ImportFailure]]]] = collections.deque()
+
+        async def drain() -> None:
+            nonlocal imported, rejected
+
+            rows, failures = await pending.popleft()
+            conflicts: list[ImportFailure] = await load_rows(connection, rows) if rows else []
+
+            write(sorted(failures + conflicts))
+            imported += len(rows) - len(conflicts)
+            rejected += len(failures) + len(conflicts)
+
+            elapsed: float = time.perf_counter() - started
+            rate: float = (imported + rejected) / elapsed
+            logger.info("Imported %s rows, rejected %s (%.0f rows/s).", imported, rejected, rate)
+
+        try:
+            for batch in read_batches(fp, fmt, args.batch_size):
+                pending.append(loop.run_in_executor(executor, parse_rows, batch))
+
+                if len(pending) > args.workers:
+                    await drain()
+
+            while pending:
+                await drain()
+        finally:
+            await connection.close()
+
+    try:
+        await KnownIdentifiers.reset()
+    except Exception as e:
+        logger.warning("Unable to tell running servers to rebuild their identifier filters: %s", e)
+
+    elapsed: float = time.perf_counter() - started
+    logger.info("Finished importing in %.1fs: %s imported, %s rejected.", elapsed, imported, rejected)
+
+
+if __name__ == "__main__":
+    core.setup_logging(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
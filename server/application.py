@@ -18,7 +18,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import logging
-from typing import TYPE_CHECKING, Any, Self
+from typing import TYPE_CHECKING, Any, Literal, Self
 
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
@@ -31,6 +31,7 @@ import views
 
 if TYPE_CHECKING:
     from database import Database
+    from types_ import User
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -40,6 +41,11 @@ class Server(core.Application):
     def __init__(self, *, database: Database) -> None:
         self.database = database
 
+        qcfg = core.config.get("QR", {})
+        self.renderer: core.QRRenderer = core.QRRenderer(
+            workers=qcfg.get("workers", 2), max_pending=qcfg.get("max_pending", 16)
+        )
+
         super().__init__(
             prefix=None,
             views=[views.Web(self), views.Redirects(self), views.API(self)],
@@ -59,15 +65,32 @@ class Server(core.Application):
                     core.SessionMiddleware,
                     secret=core.config["SESSIONS"]["secret"],
                     max_age=core.config["SESSIONS"]["max_age"],
+                    bypass=core.config["SESSIONS"].get("bypass", ["^/static/", "^/docs/", "^/qr/", "^/[A-Za-z0-9]+$"]),
+                    backend=core.config["SESSIONS"].get("backend", "redis"),
+                    cookie_max_size=core.config["SESSIONS"].get("cookie_max_size", 3800),
+                    compress=core.config["SESSIONS"].get("compress", True),
+                    cache_size=core.config["SESSIONS"].get("cache_size", 10000),
+                    cache_ttl=core.config["SESSIONS"].get("cache_ttl", 2.0),
                 ),
             ],
         )
 
+    def peek_user(self, *, token: str | None = None, uid: int | None = None) -> User | Literal[False] | None:
+        return self.database.peek_user(token=token, uid=uid)
+
+    async def fetch_user(self, *, token: str | None = None, uid: int | None = None) -> User | None:
+        return await self.database.fetch_user(token=token, uid=uid)
+
     async def setup_hook(self) -> None:
+        self.database.sweeper.start()
+        self.database.rollup.start()
         logger.info("Server has completed setup...")
 
     async def teardown(self) -> None:
         logger.info("Server is shutting down...")
+        await self.database.sweeper.close()
+        await self.database.rollup.close()
+        self.renderer.close()
 
     async def __aenter__(self) -> Self:
         await self.setup_hook()
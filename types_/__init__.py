@@ -17,4 +17,5 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from .database import *
 from .limits import *
+from .metrics import *
 from .requests import *
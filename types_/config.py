@@ -15,16 +15,46 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from typing import TypedDict
+from typing import Literal, NotRequired, TypedDict
+
+from .database import IdentifierScheme
 
 
 class ServerConfig(TypedDict):
     host: str
     port: int
+    trusted_proxies: NotRequired[list[str]]
+    ipv4_prefix: NotRequired[int]
+    ipv6_prefix: NotRequired[int]
 
 
 class DatabaseConfig(TypedDict):
     dsn: str
+    views_flush_interval: NotRequired[int]
+    views_flush_threshold: NotRequired[int]
+    sweep_interval: NotRequired[int]
+    sweep_batch_size: NotRequired[int]
+    views_hourly_retention: NotRequired[int]
+    views_rollup_interval: NotRequired[int]
+    views_rollup_batch_size: NotRequired[int]
+    min_size: NotRequired[int]
+    max_size: NotRequired[int]
+    max_queries: NotRequired[int]
+    max_inactive_connection_lifetime: NotRequired[float]
+    statement_cache_size: NotRequired[int]
+    server_settings: NotRequired[dict[str, str]]
+    init_sql: NotRequired[str]
+    replica_dsns: NotRequired[list[str]]
+    replica_check_interval: NotRequired[int]
+
+
+class IdentifiersConfig(TypedDict, total=False):
+    scheme: IdentifierScheme
+    length: int
+    pool_size: int
+    permute: bool
+    secret: str
+    max_attempts: int
 
 
 class LoggingConfig(TypedDict):
@@ -37,6 +67,11 @@ class OptionsConfig(TypedDict):
     min_url_length: int
     github_url: str
     discord_url: str
+    enable_metrics: NotRequired[bool]
+    max_bulk_size: NotRequired[int]
+    max_stats_size: NotRequired[int]
+    max_concurrent_exports: NotRequired[int]
+    dedupe: NotRequired[bool]
 
 
 class RateLimit(TypedDict):
@@ -50,6 +85,16 @@ class Limits(TypedDict):
     qr: RateLimit
     stats: RateLimit
     homepage: RateLimit
+    bulk: NotRequired[RateLimit]
+    export: NotRequired[RateLimit]
+
+
+class LimiterConfig(TypedDict, total=False):
+    max_keys: int
+    backend: Literal["memory", "redis"]
+    lease_size: int
+    lease_ttl: float
+    donator_multiplier: int
 
 
 class Domain(TypedDict):
@@ -65,14 +110,46 @@ class RedisConfig(TypedDict):
 class SessionsConfig(TypedDict):
     secret: str
     max_age: int
+    bypass: NotRequired[list[str]]
+    backend: NotRequired[Literal["redis", "cookie"]]
+    cookie_max_size: NotRequired[int]
+    compress: NotRequired[bool]
+    cache_size: NotRequired[int]
+    cache_ttl: NotRequired[float]
+
+
+class CacheConfig(TypedDict, total=False):
+    redirects_max_size: int
+    redirects_ttl: int
+    users_max_size: int
+    users_ttl: int
+    missing_max_size: int
+    missing_ttl: int
+    bloom: bool
+    bloom_capacity: int
+    bloom_error_rate: float
+    locations_max_size: int
+
+
+class QRConfig(TypedDict, total=False):
+    cache_size: int
+    cache_dir: str
+    cache_dir_max_size: int
+    max_age: int
+    workers: int
+    max_pending: int
 
 
 class ConfigType(TypedDict):
     SERVER: ServerConfig
     DATABASE: DatabaseConfig
+    IDENTIFIERS: NotRequired[IdentifiersConfig]
     LOGGING: LoggingConfig
     OPTIONS: OptionsConfig
     LIMITS: Limits
+    LIMITER: NotRequired[LimiterConfig]
     DOMAIN: Domain
     REDIS: RedisConfig
     SESSIONS: SessionsConfig
+    CACHE: NotRequired[CacheConfig]
+    QR: NotRequired[QRConfig]
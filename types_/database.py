@@ -16,10 +16,17 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import datetime
-from typing import TypedDict
+from typing import Literal, TypeAlias, TypedDict
 
 
-__all__ = ("Redirect",)
+__all__ = ("ExportFormat", "IdentifierScheme", "Redirect", "SeriesKind", "User", "ViewSeries")
+
+
+ExportFormat: TypeAlias = Literal["ndjson", "csv"]
+IdentifierScheme: TypeAlias = Literal["random", "sequence"]
+SeriesKind: TypeAlias = Literal["hourly", "daily"]
+# Sparse (ISO 8601 bucket, views) pairs in ascending order. Buckets without views are left out...
+ViewSeries: TypeAlias = list[tuple[str, int]]
 
 
 class Redirect(TypedDict):
@@ -28,3 +35,11 @@ class Redirect(TypedDict):
     expiry: datetime.datetime | None
     location: str
     views: int
+
+
+class User(TypedDict):
+    id: int
+    email: str
+    moderator: bool
+    donator: bool
+    token: str
@@ -18,7 +18,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 from collections.abc import Awaitable, Callable
-from typing import TYPE_CHECKING, Any, Literal, TypeAlias, TypedDict
+from typing import Any, Literal, TypeAlias, TypedDict
 
 from starlette.requests import Request
 
@@ -27,16 +27,20 @@ from core.core import _Route
 from .requests import ResponseType
 
 
-if TYPE_CHECKING:
-    import datetime
-
-
-__all__ = ("RateLimit", "ExemptCallable", "LimitDecorator", "T_LimitDecorator", "RateLimitData", "TatStore")
+__all__ = (
+    "RateLimit",
+    "ExemptCallable",
+    "LimitDecorator",
+    "T_LimitDecorator",
+    "RateLimitData",
+    "LimiterBackendName",
+)
 
 
 ExemptCallable: TypeAlias = Callable[[Request], Awaitable[bool]] | None
 LimitDecorator: TypeAlias = Callable[[Any, Request], ResponseType] | _Route
 T_LimitDecorator: TypeAlias = Callable[..., LimitDecorator]
+LimiterBackendName: TypeAlias = Literal["memory", "redis"]
 
 
 class RateLimitData(TypedDict):
@@ -44,13 +48,9 @@ class RateLimitData(TypedDict):
     per: int
     bucket: Literal["ip", "user"]
     exempt: ExemptCallable
+    backend: LimiterBackendName | None
 
 
 class RateLimit(TypedDict):
     rate: int
     per: int
-
-
-class TatStore(TypedDict):
-    tat: datetime.datetime
-    limit: Any
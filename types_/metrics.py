@@ -0,0 +1,77 @@
+"""Chii. A simple URL shortner with a focus on privacy.
+
+Copyright (C) 2024  Mysty <evieepy@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from typing import TypedDict
+
+
+__all__ = ("CacheStats", "DatabaseMetrics", "FilterMetrics", "PoolMetrics", "RendererStats", "ReplicaMetrics")
+
+
+class CacheStats(TypedDict):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+
+
+class PoolMetrics(TypedDict):
+    size: int
+    idle: int
+    in_use: int
+    min_size: int
+    max_size: int
+    waiting: int
+    acquires: int
+    average_acquire_ms: float
+    max_acquire_ms: float
+
+
+class ReplicaMetrics(TypedDict):
+    total: int
+    healthy: int
+    fallbacks: int
+
+
+class FilterMetrics(TypedDict):
+    enabled: bool
+    subscribed: bool
+    ready: bool
+    identifiers: int
+    capacity: int
+    rejected: int
+    missing_cache: CacheStats
+
+
+class DatabaseMetrics(TypedDict):
+    redirect_cache: CacheStats
+    user_cache: CacheStats
+    pool: PoolMetrics
+    replicas: ReplicaMetrics
+    coalesced_lookups: int
+    filter: FilterMetrics
+
+
+class RendererStats(TypedDict):
+    workers: int
+    pending: int
+    max_pending: int
+    rendered: int
+    rejected: int
+    errors: int
+    restarts: int
+    average_render_ms: float
+    last_render_ms: float
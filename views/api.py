@@ -18,88 +18,113 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 import asyncio
-import io
+import gzip
+import hashlib
+import json
 import logging
-from typing import TYPE_CHECKING, Any
+import math
+from typing import TYPE_CHECKING, Any, Literal
 
-import qrcode
-from qrcode.image.styledpil import StyledPilImage
-from qrcode.image.styles.colormasks import SolidFillColorMask
-from qrcode.image.styles.moduledrawers.pil import RoundedModuleDrawer
-from starlette.responses import HTMLResponse, JSONResponse, Response
-from validators import ValidationError  # type: ignore
-from validators.url import url as URLVALIDATOR  # type: ignore
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 
-from core import View, config, limit, route
-from core.exceptions import URLValidationError
+from core import QRCache, View, config, limit, route, validate_url
+from core.exceptions import RendererSaturated, URLValidationError
 
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Callable
+
     from starlette.datastructures import UploadFile
     from starlette.requests import Request
 
     from server import Server
-    from types_ import Redirect
+    from types_ import ExportFormat, Redirect, SeriesKind, User, ViewSeries
+    from types_.config import RateLimit
     from types_.requests import BasicRedirect
 
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 
+BULK_LIMIT: RateLimit = config["LIMITS"].get("bulk", {"rate": 4, "per": 60})
+EXPORT_LIMIT: RateLimit = config["LIMITS"].get("export", {"rate": 2, "per": 300})
+# The amount of URLs validated and inserted per round trip when bulk creating...
+BULK_CHUNK: int = 500
+# The default amount of buckets returned for each kind of view series, and the maximum for daily series...
+SERIES_SPANS: dict[SeriesKind, int] = {"hourly": 48, "daily": 30}
+MAX_SERIES_DAYS: int = 366
+# The amount of exports which may stream at once, since each holds a pool connection and a snapshot open...
+EXPORT_CONCURRENCY: int = config["OPTIONS"].get("max_concurrent_exports", 2)
+
+
 class API(View):
     def __init__(self, app: Server) -> None:
         self.app = app
 
-    def validate_url(self, __value: Any, /) -> str:
-        options: dict[str, bool] = {
-            "skip_ipv6_addr": True,
-            "skip_ipv4_addr": True,
+        qcfg = config.get("QR", {})
+        self.qr_cache: QRCache = QRCache(
+            max_size=qcfg.get("cache_size", 1024),
+            directory=qcfg.get("cache_dir"),
+            max_disk_size=qcfg.get("cache_dir_max_size", 256 * 1024 * 1024),
+        )
+        self.qr_headers: dict[str, str] = {
+            "Cache-Control": f"public, max-age={qcfg.get('max_age', 86400)}",
+            "Vary": "Accept-Encoding",
         }
+        self.exporting: int = 0
 
-        out: ValidationError | bool = URLVALIDATOR(__value, **options)
-        if isinstance(out, ValidationError):
-            raise URLValidationError from out
+    def validate_url(self, __value: Any, /) -> str:
+        return validate_url(__value)
 
-        if out is not True:
-            raise URLValidationError
+    async def authenticate(self, request: Request, /) -> User | None:
+        token: str | None = request.headers.get("Authorization")
 
-        domain: str = config["DOMAIN"]["name"]
+        if not token:
+            return None
 
-        if domain in __value:
-            raise URLValidationError(f"Can not contain the domain: {domain}")
+        return await self.app.fetch_user(token=token.removeprefix("Bearer ").strip())
 
-        max_: int = config["OPTIONS"]["max_url_length"]
-        min_: int = config["OPTIONS"]["min_url_length"]
-        len_: int = len(__value)
+    def validate_urls(self, values: list[Any], /) -> list[str | URLValidationError]:
+        """Validate a batch of URLs, returning either the validated URL or the error for each, in order."""
+        results: list[str | URLValidationError] = []
 
-        if len_ > max_:
-            raise URLValidationError(reason=f"The provided URL exceeds the maximum length of ({max_})")
-        elif len_ < min_:
-            raise URLValidationError(reason=f"The provided URL must be over ({min_}) characters long")
+        for value in values:
+            location: Any = value.get("url") if isinstance(value, dict) else value  # type: ignore
 
-        return __value
+            if not isinstance(location, str):
+                results.append(URLValidationError(reason="Expected a URL string or an object with a url field."))
+                continue
 
-    def generate_qr(self, __value: str, /) -> io.BytesIO:
-        qr = qrcode.QRCode(  # type: ignore
-            error_correction=qrcode.constants.ERROR_CORRECT_L,  # type: ignore
-            box_size=10,
-            border=4,
-        )
+            try:
+                results.append(self.validate_url(location))
+            except URLValidationError as e:
+                results.append(e)
 
-        qr.add_data(__value)  # type: ignore
+        return results
 
-        img = qr.make_image(  # type: ignore
-            image_factory=StyledPilImage,
-            module_drawer=RoundedModuleDrawer(radius_ratio=1),
-            color_mask=SolidFillColorMask(front_color=(119, 90, 165), back_color=(249, 241, 239)),
-        )
+    def series_options(self, request: Request, /) -> tuple[SeriesKind | None, int]:
+        """Parse the series and span query parameters of a stats request. Raises ValueError with a message safe to
+        return to the client when either is invalid.
+        """
+        kind: str | None = request.query_params.get("series")
+        if kind is None:
+            return None, 0
 
-        fp: io.BytesIO = io.BytesIO()
-        img.save(fp, "PNG")  # type: ignore
-        img.close()  # type: ignore
+        if kind not in SERIES_SPANS:
+            raise ValueError('Series must be "hourly" or "daily".')
 
-        fp.seek(0)
-        return fp
+        # Hours older than the retention have been rolled up into days, so can not be returned hourly...
+        maximum: int = self.app.database.rollup.retention * 24 if kind == "hourly" else MAX_SERIES_DAYS
+
+        try:
+            span: int = int(request.query_params.get("span", SERIES_SPANS[kind]))
+        except ValueError:
+            raise ValueError("Span must be an integer.") from None
+
+        if not 1 <= span <= maximum:
+            raise ValueError(f"Span must be between 1 and {maximum} for {kind} series.")
+
+        return kind, span  # type: ignore
 
     def generate_html(self, request: Request, /, *, identifier: str, should_qr: bool = False) -> str:
         # TODO: We probably shouldn't rely soley on request.url_for here and implement a fallback...
@@ -111,7 +136,7 @@ class API(View):
         if should_qr:
             qr_html = f"""
             <div class="innerDetails">
-                <a href="/qr/{identifier}"><img src="/qr/{identifier}" class="qrDisplay"></a>
+                <a href="/qr/{identifier}"><img src="/qr/{identifier}?format=svg" class="qrDisplay"></a>
             </div>
             """
 
@@ -137,7 +162,7 @@ class API(View):
         return html
 
     @route("/create", methods=["POST"])
-    @limit(config["LIMITS"]["create"]["rate"], config["LIMITS"]["create"]["per"])
+    @limit(config["LIMITS"]["create"]["rate"], config["LIMITS"]["create"]["per"], bucket="user")
     async def create_url(self, request: Request) -> Response:
         """Create a shortened URL via API.
 
@@ -229,6 +254,138 @@ class API(View):
 
         return JSONResponse(data)
 
+    @route("/create/bulk", methods=["POST"])
+    @limit(BULK_LIMIT["rate"], BULK_LIMIT["per"], bucket="user")
+    async def create_bulk(self, request: Request) -> Response:
+        """Create many shortened URLs at once via API.
+
+        ---
+        summary: Create many short URLs.
+        description:
+            Requires an Authorization token. Accepts either a JSON array, or newline delimited JSON when sent with a
+            Content-Type of application/x-ndjson. Each item may be a URL string or an object with a url field.
+            Results are streamed back as newline delimited JSON, one line per item, in the same order.
+
+        requestBody:
+            content:
+                application/json:
+                    schema:
+                        type: array
+                        items:
+                            type: string
+                            example: https://google.com?q=Pizza
+
+        responses:
+            200:
+                description: One result per line. Failed items have an error field instead of the URL data.
+                content:
+                    application/x-ndjson:
+                        schema:
+                            type: object
+                            properties:
+                                index:
+                                    type: integer
+                                    example: 0
+                                url:
+                                    type: string
+                                    example: https://chii.to/abc123
+                                qr:
+                                    type: string
+                                    example: https://chii.to/qr/abc123
+                                location:
+                                    type: string
+                                    example: https://google.com?q=Pizza
+                                id:
+                                    type: string
+                                    example: abc123
+                                error:
+                                    type: string
+                                    example: An incorrect, invalid or improper URL was passed.
+            400:
+                description: The body could not be parsed or contained too many URLs.
+            401:
+                description: A valid Authorization token was not provided.
+        """
+        user: User | None = await self.authenticate(request)
+
+        if not user:
+            return JSONResponse({"error": "A valid Authorization token is required."}, status_code=401)
+
+        try:
+            items: list[Any] = await self._read_bulk(request)
+        except ValueError as e:
+            return JSONResponse({"error": "Unable to parse data.", "extra": str(e)}, status_code=400)
+
+        # Build the URLs by hand, since url_for is far too slow to call thousands of times...
+        short: str = str(request.url_for("Redirects.redirect_base", id="_")).removesuffix("_")
+        qr: str = str(request.url_for("API.display_qr_code", id="_")).removesuffix("_")
+
+        return StreamingResponse(
+            self._create_bulk(items, uid=user["id"], short=short, qr=qr), media_type="application/x-ndjson"
+        )
+
+    async def _read_bulk(self, request: Request, /) -> list[Any]:
+        maximum: int = config["OPTIONS"].get("max_bulk_size", 1000)
+        max_bytes: int = maximum * (config["OPTIONS"]["max_url_length"] + 64)
+
+        body: bytearray = bytearray()
+        async for chunk in request.stream():
+            body += chunk
+
+            if len(body) > max_bytes:
+                raise ValueError(f"The request body exceeds the maximum size of ({max_bytes}) bytes")
+
+        items: Any
+        if "ndjson" in request.headers.get("Content-Type", ""):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON array or newline delimited JSON")
+
+        if len(items) > maximum:  # type: ignore
+            raise ValueError(f"At most ({maximum}) URLs can be created at once")
+
+        return items  # type: ignore
+
+    async def _create_bulk(self, items: list[Any], /, *, uid: int, short: str, qr: str) -> AsyncIterator[bytes]:
+        for start in range(0, len(items), BULK_CHUNK):
+            checked: list[str | URLValidationError] = await asyncio.to_thread(
+                self.validate_urls, items[start : start + BULK_CHUNK]
+            )
+
+            valid: list[int] = [i for i, result in enumerate(checked) if isinstance(result, str)]
+            payloads: list[BasicRedirect] = [{"uid": uid, "expiry": None, "location": str(checked[i])} for i in valid]
+
+            rows: list[Redirect | None]
+            try:
+                rows = await self.app.database.create_redirects(payloads) if payloads else []
+            except Exception as e:
+                logger.warning("Unable to bulk create %s redirects: %s", len(payloads), e)
+                rows = [None] * len(payloads)
+
+            created: dict[int, Redirect | None] = dict(zip(valid, rows))
+            lines: list[str] = []
+
+            for offset, result in enumerate(checked):
+                data: dict[str, Any] = {"index": start + offset}
+
+                if isinstance(result, URLValidationError):
+                    data["error"] = "An incorrect, invalid or improper URL was passed."
+                    data["extra"] = result.reason or str(result)
+                elif (row := created[offset]) is None:
+                    data["error"] = "Internal server error: (Database)"
+                else:
+                    data.update(row)
+                    data.pop("uid", None)
+                    data["url"] = f"{short}{row['id']}"
+                    data["qr"] = f"{qr}{row['id']}"
+
+                lines.append(json.dumps(data, default=str))
+
+            yield ("\n".join(lines) + "\n").encode()
+
     @route("/web/create", methods=["POST"])
     @limit(config["LIMITS"]["create"]["rate"], config["LIMITS"]["create"]["per"])
     async def web_create_url(self, request: Request) -> Response:
@@ -294,17 +451,181 @@ class API(View):
         if not row:
             return Response(status_code=404)
 
-        short: str = str(request.url_for("Redirects.redirect_base", id=identifier))
+        # PNG stays the default regardless of Accept, so existing embeds always receive the same image...
+        fmt: str = request.query_params.get("format", "png")
+
+        if fmt not in ("png", "svg"):
+            return JSONResponse({"error": 'Unknown format. Expected one of: "png", "svg".'}, status_code=400)
+
+        # SVGs are small and compress well, so they are stored gzipped and sent as-is to clients which accept it...
+        svg: bool = fmt == "svg"
+        stored: Literal["png", "svgz"] = "svgz" if svg else "png"
+        media_type: str = "image/svg+xml" if svg else "image/png"
+        gzipped: bool = svg and "gzip" in request.headers.get("Accept-Encoding", "")
+
+        # Always encode the configured domain; the Host header is client controlled and would multiply cache entries...
+        short: str = str(
+            request.url_for("Redirects.redirect_base", id=identifier).replace(netloc=config["DOMAIN"]["name"])
+        )
+        key: str = self.qr_cache.key(short, fmt=stored)
+        headers: dict[str, str] = {**self.qr_headers, "ETag": f'"{key}{"-gzip" if gzipped else ""}"'}
+
+        if headers["ETag"] in request.headers.get("If-None-Match", ""):
+            return Response(status_code=304, headers=headers)
+
+        if gzipped:
+            headers["Content-Encoding"] = "gzip"
+
+        data: bytes | None = self.qr_cache.get(key)
+
+        if data is None and (path := self.qr_cache.path(key, fmt=stored)) is not None:
+            if not svg or gzipped:
+                return FileResponse(path, media_type=media_type, headers=headers)
+
+            data = await asyncio.to_thread(path.read_bytes)
+
+        if data is None:
+            try:
+                data = await self.app.renderer.render(short, fmt="svg" if svg else "png")
+            except RendererSaturated as e:
+                return Response(status_code=503, headers={"Retry-After": str(math.ceil(e.retry_after))})
+            except Exception as e:
+                logger.warning("Unable to render QR code for %s: %s", identifier, e)
+                return Response(status_code=500)
+
+            if svg:
+                data = gzip.compress(data)
+
+            await self.qr_cache.set(key, data, fmt=stored)
+
+        if svg and not gzipped:
+            data = gzip.decompress(data)
+
+        return Response(data, media_type=media_type, headers=headers)
 
+    @route("/stats", methods=["GET", "POST"])
+    @limit(config["LIMITS"]["stats"]["rate"], config["LIMITS"]["stats"]["per"], bucket="user")
+    async def batch_stats(self, request: Request) -> Response:
+        """Retrieve stats for many short URLs at once.
+
+        ---
+        summary: Retrieve stats for many short URLs.
+        description:
+            Takes a comma separated ids query parameter, or a JSON array of ids when sent as a POST. Returns an array
+            in the same order, with null for any id which does not exist. Responses carry an ETag; send it back in
+            If-None-Match to receive a 304 when nothing has changed. Pass series=hourly or series=daily to include a
+            sparse view time series for each id, covering the last span hours or days.
+
+        parameters:
+            - in: query
+              name: ids
+              schema:
+                type: string
+                example: abc123,def456
+            - in: query
+              name: series
+              schema:
+                type: string
+                enum: [hourly, daily]
+            - in: query
+              name: span
+              schema:
+                type: integer
+                example: 48
+
+        responses:
+            200:
+                description: The stats for each id, or null.
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items:
+                                type: object
+                                properties:
+                                    id:
+                                        type: string
+                                        example: abc123
+                                    location:
+                                        type: string
+                                        example: https://example.com
+                                    expiry:
+                                        type: string
+                                        example: 2024-01-01T00:00:00.000000+00:00
+                                    views:
+                                        type: integer
+                                        example: 0
+                                    series:
+                                        type: array
+                                        items:
+                                            type: array
+                                        example: [["2024-01-01T00:00:00+00:00", 3]]
+            304:
+                description: The stats have not changed since the ETag sent in If-None-Match.
+            400:
+                description: The ids were missing, invalid or too many, or the series options were invalid.
+        """
         try:
-            fp: io.BytesIO = await asyncio.to_thread(self.generate_qr, short)
-        except Exception:
-            return Response(status_code=500)
+            kind, span = self.series_options(request)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        identifiers: Any
+
+        if request.method == "POST":
+            try:
+                identifiers = await request.json()
+            except Exception:
+                return JSONResponse({"error": "Unable to parse data.", "extra": "Expected a JSON array of ids."}, 400)
+        else:
+            identifiers = [i for value in request.query_params.getlist("ids") for i in value.split(",") if i]
+
+        valid: bool = isinstance(identifiers, list) and all(isinstance(i, str) for i in identifiers)  # type: ignore
+        if not identifiers or not valid:
+            return JSONResponse({"error": "Missing or invalid ids.", "extra": "Expected a list of ids."}, 400)
+
+        maximum: int = config["OPTIONS"].get("max_stats_size", 500)
+        if len(identifiers) > maximum:  # type: ignore
+            return JSONResponse({"error": f"At most ({maximum}) ids can be requested at once."}, 400)
+
+        found: dict[str, Redirect] = await self.app.database.retrieve_redirects(identifiers)  # type: ignore
+        pending: Callable[[str], int] = self.app.database.views.pending
 
-        return Response(fp.read(), media_type="image/png")
+        series: dict[str, ViewSeries] = {}
+        if kind and found:
+            series = await self.app.database.view_series(list(found), kind=kind, span=span)
+
+        data: list[dict[str, Any] | None] = []
+        for identifier in identifiers:  # type: ignore
+            row: Redirect | None = found.get(identifier)  # type: ignore
+
+            if row is None:
+                data.append(None)
+                continue
+
+            item: dict[str, Any] = {
+                "id": row["id"],
+                "location": row["location"],
+                "expiry": row["expiry"].isoformat() if row["expiry"] else None,
+                "views": row["views"] + pending(row["id"]),
+            }
+
+            if kind:
+                item["series"] = series.get(row["id"], [])
+
+            data.append(item)
+
+        body: bytes = json.dumps(data, separators=(",", ":")).encode()
+        etag: str = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        headers: dict[str, str] = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status_code=304, headers=headers)
+
+        return Response(body, media_type="application/json", headers=headers)
 
     @route("/stats/{id}", methods=["GET"])
-    @limit(config["LIMITS"]["stats"]["rate"], config["LIMITS"]["stats"]["per"])
+    @limit(config["LIMITS"]["stats"]["rate"], config["LIMITS"]["stats"]["per"], bucket="user")
     async def redirect_stats(self, request: Request) -> Response:
         """Create a shortened URL via API.
 
@@ -312,6 +633,20 @@ class API(View):
         summary: Retrieve basic stats for a short URL.
         description:
             Retrieve basic stats for a short URL. This includes the URL, QR code, location, expiry, ID and views.
+            Pass series=hourly or series=daily to include a sparse view time series covering the last span hours or
+            days. Only aggregate counts are kept; nothing about who viewed a URL is stored.
+
+        parameters:
+            - in: query
+              name: series
+              schema:
+                type: string
+                enum: [hourly, daily]
+            - in: query
+              name: span
+              schema:
+                type: integer
+                example: 48
 
         responses:
             200:
@@ -339,18 +674,103 @@ class API(View):
                                 views:
                                     type: integer
                                     example: 0
+                                series:
+                                    type: array
+                                    items:
+                                        type: array
+                                    example: [["2024-01-01", 12]]
+            400:
+                description: The series options were invalid.
             404:
                 description: The URL was not found.
         """
+        try:
+            kind, span = self.series_options(request)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
         identifier: str = request.path_params["id"]
         row: Redirect | None = await self.app.database.retrieve_redirect(identifier, plus=False)
 
         if not row:
             return Response(status_code=404)
 
-        data = dict(row)
+        data: dict[str, Any] = dict(row)
         data.pop("uid", None)
+        data["views"] += self.app.database.views.pending(identifier)
         data["url"] = str(request.url_for("Redirects.redirect_base", id=identifier))
         data["qr"] = str(request.url_for("API.display_qr_code", id=identifier))
 
+        if kind:
+            data["series"] = (await self.app.database.view_series([identifier], kind=kind, span=span))[identifier]
+
         return JSONResponse(data)
+
+    @route("/export", methods=["GET"])
+    @limit(EXPORT_LIMIT["rate"], EXPORT_LIMIT["per"], bucket="user")
+    async def export(self, request: Request) -> Response:
+        """Export every short URL.
+
+        ---
+        summary: Export every short URL.
+        description:
+            Requires a moderator Authorization token. Streams every short URL as newline delimited JSON, or CSV with
+            format=csv. Each export holds a database connection until it finishes, so only a few may run at once.
+
+        parameters:
+            - in: query
+              name: format
+              schema:
+                type: string
+                enum: [ndjson, csv]
+
+        responses:
+            200:
+                description: Every short URL, with the id, uid, expiry, location and views of each.
+            400:
+                description: The format was unknown.
+            401:
+                description: A valid Authorization token was not provided.
+            403:
+                description: The token does not belong to a moderator.
+            503:
+                description: Too many exports are already running.
+        """
+        user: User | None = await self.authenticate(request)
+
+        if not user:
+            return JSONResponse({"error": "A valid Authorization token is required."}, status_code=401)
+
+        if not user["moderator"]:
+            return JSONResponse({"error": "Only moderators can export short URLs."}, status_code=403)
+
+        fmt: str = request.query_params.get("format", "ndjson")
+        if fmt not in ("ndjson", "csv"):
+            return JSONResponse({"error": 'Unknown format. Expected one of: "ndjson", "csv".'}, status_code=400)
+
+        # Moderators are exempt from rate limits, so the amount of running exports is capped as well...
+        if self.exporting >= EXPORT_CONCURRENCY:
+            return JSONResponse({"error": "Too many exports are running. Try again later."}, 503, {"Retry-After": "60"})
+
+        chunks: AsyncIterator[bytes] = self._export(fmt="csv" if fmt == "csv" else "ndjson")
+        return StreamingResponse(
+            chunks,
+            media_type="text/csv" if fmt == "csv" else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="redirects.{fmt}"'},
+        )
+
+    async def _export(self, *, fmt: ExportFormat) -> AsyncIterator[bytes]:
+        self.exporting += 1
+
+        try:
+            async for chunk in self.app.database.export_redirects(fmt=fmt):
+                yield chunk
+        finally:
+            self.exporting -= 1
+
+    @route("/metrics", methods=["GET"])
+    async def metrics(self, request: Request) -> Response:
+        if not config["OPTIONS"].get("enable_metrics", False):
+            return Response(status_code=404)
+
+        return JSONResponse({"database": self.app.database.metrics(), "qr": self.app.renderer.stats()})
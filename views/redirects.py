@@ -29,7 +29,6 @@ if TYPE_CHECKING:
     from starlette.requests import Request
 
     from server import Server
-    from types_ import Redirect
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -43,9 +42,9 @@ class Redirects(View):
     @limit(config["LIMITS"]["redirect"]["rate"], config["LIMITS"]["redirect"]["per"])
     async def redirect_base(self, request: Request) -> Response:
         identifier: str = request.path_params["id"]
-        row: Redirect | None = await self.app.database.retrieve_redirect(identifier, plus=True)
+        location: str | None = await self.app.database.resolve_redirect(identifier)
 
-        if not row:
+        if not location:
             return Response(status_code=404)
 
-        return RedirectResponse(url=row["location"], status_code=307)
+        return RedirectResponse(url=location, status_code=307)